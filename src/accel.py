@@ -0,0 +1,263 @@
+import types
+from multiprocessing import parent_process
+
+import numpy as np
+
+import signals
+import visual
+
+try:
+    import numba
+except ImportError:  # optional, every kernel falls back to the numpy version
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+
+# lets llvm vectorize the sums, which changes their rounding but not nan handling
+_REASSOCIATE = {"reassoc", "contract"}
+
+
+def _compile(**options):
+    """
+    compiles a kernel twice, with its prange loop run on numba's threads and
+    serially. kernel(*args, parallel) takes the threaded one only when asked to and
+    outside of pool workers, which already split the patches between processes.
+    numba's default thread pool is not fork-safe: a process that forks (e.g.
+    run_row_bands) after starting it hangs on exit, so callers that fork later
+    pass parallel=False.
+    numba names its cache files after the function, so the serial one is compiled
+    from a renamed copy; otherwise both would load whichever was cached first.
+    """
+
+    def decorator(function):
+        serial_function = types.FunctionType(
+            function.__code__,
+            function.__globals__,
+            function.__name__ + "_serial",
+            function.__defaults__,
+            function.__closure__,
+        )
+        serial_function.__qualname__ = function.__qualname__ + "_serial"
+
+        threaded = numba.njit(parallel=True, cache=True, **options)(function)
+        serial = numba.njit(cache=True, **options)(serial_function)
+
+        def kernel(*args, parallel=True):
+            if parallel and parent_process() is None:
+                return threaded(*args)
+            return serial(*args)
+
+        return kernel
+
+    return decorator
+
+
+if HAVE_NUMBA:
+
+    @_compile(error_model="numpy")
+    def _pos_kernel(means, out):
+        n_signals, n_frames, _ = means.shape
+        for i in numba.prange(n_signals):
+            normalized = np.empty((3, n_frames))
+            for c in range(3):
+                mean = 0.0
+                for t in range(n_frames):
+                    mean += means[i, t, c]
+                mean /= n_frames
+                variance = 0.0
+                for t in range(n_frames):
+                    variance += (means[i, t, c] - mean) ** 2
+                std = np.sqrt(variance / n_frames)
+                for t in range(n_frames):
+                    normalized[c, t] = (means[i, t, c] - mean) / std
+
+            # S1 = G - B and S2 = -2R + G + B of the normalized means
+            s1 = normalized[1] - normalized[2]
+            s2 = -2 * normalized[0] + normalized[1] + normalized[2]
+            alpha = np.std(s1) / np.std(s2)
+            for t in range(n_frames):
+                out[i, t] = s1[t] - alpha * s2[t]
+
+    @_compile(fastmath=_REASSOCIATE)
+    def _snr_kernel(flat_signals, cos_table, sin_table, signal_power, noise_power):
+        n_signals, n = flat_signals.shape
+        for i in numba.prange(n_signals):
+            total = 0.0
+            dc = 0.0
+            nyquist = 0.0
+            for t in range(n):
+                x = np.float64(flat_signals[i, t])
+                total += x * x
+                dc += x
+                nyquist += x if t % 2 == 0 else -x
+            # parseval: the power of the bins from 0 up to (not including) nyquist
+            one_sided = n * total + dc * dc
+            if n % 2 == 0:
+                one_sided -= nyquist * nyquist
+            one_sided /= 2
+
+            band = 0.0
+            for k in range(cos_table.shape[0]):
+                real = 0.0
+                imag = 0.0
+                for t in range(n):
+                    x = np.float64(flat_signals[i, t])
+                    real += x * cos_table[k, t]
+                    imag += x * sin_table[k, t]
+                band += real * real + imag * imag
+
+            signal_power[i] = band / n
+            noise_power[i] = (one_sided - band) / n
+
+    @_compile(fastmath=_REASSOCIATE)
+    def _delay_kernel(flat_signals, ref_centered, max_lag, interpolate, out):
+        n_signals, n = flat_signals.shape
+        n_lags = 2 * max_lag + 1
+        for i in numba.prange(n_signals):
+            centered = flat_signals[i] - np.mean(flat_signals[i])
+
+            correlation = np.empty(n_lags)
+            peak = 0
+            for k in range(n_lags):
+                lag = k - max_lag
+                acc = 0.0
+                if lag >= 0:
+                    for t in range(n - lag):
+                        acc += centered[t + lag] * ref_centered[t]
+                else:
+                    for t in range(n + lag):
+                        acc += centered[t] * ref_centered[t - lag]
+                correlation[k] = acc
+                # the first maximum, or the first nan, like np.argmax
+                if not np.isnan(correlation[peak]) and (
+                    np.isnan(acc) or acc > correlation[peak]
+                ):
+                    peak = k
+
+            delay = np.float64(peak - max_lag)
+            if interpolate and n_lags > 2 and 0 < peak < n_lags - 1:
+                y0 = correlation[peak - 1]
+                y1 = correlation[peak]
+                y2 = correlation[peak + 1]
+                curvature = y0 - 2 * y1 + y2
+                if curvature != 0:
+                    delay += 0.5 * (y0 - y2) / curvature
+            out[i] = delay
+
+    @_compile()
+    def _gather_kernel(colors, index_map, out):
+        height, width = index_map.shape
+        for y in numba.prange(height):
+            for x in range(width):
+                k = index_map[y, x]
+                for c in range(colors.shape[1]):
+                    out[y, x, c] = colors[k, c]
+
+
+def get_rppg_signals(stats, methods=signals.RPPG_METHODS, parallel=True):
+    """
+    signals.get_rppg_signals with "pos" computed by a compiled loop over the
+    signals (in float64, so it differs from the float32 numpy version by rounding)
+    """
+    if not HAVE_NUMBA or "pos" not in methods:
+        return signals.get_rppg_signals(stats, methods)
+
+    other_methods = [method for method in methods if method != "pos"]
+    rppg_signals = signals.get_rppg_signals(stats, other_methods)
+
+    means = np.asarray(stats, dtype=np.float32)[..., :3]
+    n_frames = means.shape[-2]
+    pos = np.empty(means.shape[:-1], dtype=np.float32)
+    _pos_kernel(
+        np.ascontiguousarray(means.reshape(-1, n_frames, 3)),
+        pos.reshape(-1, n_frames),
+        parallel=parallel,
+    )
+    return dict(rppg_signals, pos=pos)
+
+
+def get_snr_map(patch_signals, fs, freq_range, parallel=True):
+    """
+    signals.get_snr_map without the FFT: the power inside freq_range is summed from
+    a direct DFT of only the bins in the band, the noise power is the rest of the
+    total one-sided power, which follows from parseval in one pass over the signal.
+    long signals, whose band has more than log2(T) bins, keep the FFT.
+    """
+    n = patch_signals.shape[-1]
+    freqs = np.fft.rfftfreq(n, d=1 / fs)
+    if n % 2 == 0:
+        freqs = freqs[:-1]
+    bins = np.nonzero((freqs >= freq_range[0]) & (freqs <= freq_range[1]))[0]
+    if not HAVE_NUMBA or len(bins) > np.log2(n):
+        return signals.get_snr_map(patch_signals, fs, freq_range)
+
+    flat_signals = np.ascontiguousarray(patch_signals.reshape(-1, n))
+    phase = 2 * np.pi * np.outer(bins, np.arange(n)) / n
+
+    signal_power = np.empty(len(flat_signals))
+    noise_power = np.empty(len(flat_signals))
+    _snr_kernel(
+        flat_signals,
+        np.cos(phase),
+        np.sin(phase),
+        signal_power,
+        noise_power,
+        parallel=parallel,
+    )
+
+    degenerate = (signal_power == 0) | (noise_power == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        snr = 10 * np.log10(signal_power / noise_power)
+    snr[degenerate] = np.nan
+
+    return snr.reshape(patch_signals.shape[:-1]), int(degenerate.sum())
+
+
+def get_time_delays(
+    patch_signals, signal_ref, fps, max_lag_frames, interpolate=True, parallel=True
+):
+    """
+    signals.get_time_delays with the bounded-lag cross-correlation of every signal
+    in a compiled loop over the signals (the "direct" method)
+    """
+    if not HAVE_NUMBA:
+        return signals.get_time_delays(
+            patch_signals, signal_ref, fps, max_lag_frames, interpolate=interpolate
+        )
+
+    n = patch_signals.shape[-1]
+    flat_signals = np.ascontiguousarray(patch_signals.reshape(-1, n), dtype=np.float64)
+    delays = np.empty(len(flat_signals))
+
+    if max_lag_frames < 0:
+        delays[:] = np.nan
+        return delays.reshape(patch_signals.shape[:-1])
+
+    signal_ref = np.asarray(signal_ref, dtype=np.float64)
+    _delay_kernel(
+        flat_signals,
+        signal_ref - np.mean(signal_ref),
+        min(max_lag_frames, n - 1),
+        interpolate,
+        delays,
+        parallel=parallel,
+    )
+    return (delays / fps).reshape(patch_signals.shape[:-1])
+
+
+def iter_heatmap_frames(patch_values, index_map, lut, background=0, parallel=True):
+    """
+    visual.iter_heatmap_frames with the gather through index_map in a compiled
+    loop over rows
+    """
+    if not HAVE_NUMBA:
+        yield from visual.iter_heatmap_frames(patch_values, index_map, lut, background)
+        return
+
+    index_map = np.ascontiguousarray(index_map)
+    for values in patch_values:
+        colors = lut[np.append(values, np.uint8(background))]
+        frame = np.empty(index_map.shape + colors.shape[1:], dtype=colors.dtype)
+        _gather_kernel(colors, index_map, frame, parallel=parallel)
+        yield frame
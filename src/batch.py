@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+matplotlib.use("Agg")  # headless: figures are only ever saved
+
+import cv2
+import numpy as np
+
+from extract import Pipeline
+from signals import RPPG_METHODS
+
+SEG_MASKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "seg_masks")
+
+
+def load_manifest(manifest_path):
+    """
+    reads a .json list or a .jsonl file of entries like
+    {"video": "face.mp4", "mask": "face.npy", "center": [y, x], "name": "face"}
+    where everything except "video" is optional
+    """
+    with open(manifest_path) as f:
+        if manifest_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def mask_center_point(mask):
+    """
+    the mask pixel furthest from the mask border, a headless stand-in for
+    select_center_point that always lands inside the skin region
+    """
+    distance = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 5)
+    y, x = np.unravel_index(np.argmax(distance), distance.shape)
+    return int(y), int(x)
+
+
+def _video_name(entry):
+    return os.path.splitext(os.path.basename(entry.get("video", "")))[0]
+
+
+def get_entry_names(entries):
+    """
+    the output directory name of every entry: its "name", or else the video file
+    name, with a _2, _3, ... suffix in manifest order for videos that share one
+    (a/clip.mp4 and b/clip.mp4). explicit names must be unique.
+    """
+    explicit = [entry["name"] for entry in entries if entry.get("name")]
+    duplicates = sorted({name for name in explicit if explicit.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Several entries are named {', '.join(duplicates)}")
+
+    names = []
+    used = set(explicit)
+    for entry in entries:
+        name = entry.get("name")
+        if not name:
+            name = stem = _video_name(entry)
+            suffix = 1
+            while name in used:
+                suffix += 1
+                name = f"{stem}_{suffix}"
+            used.add(name)
+        names.append(name)
+    return names
+
+
+def resolve_entry(entry, mask_dir, name):
+    video_path = entry["video"]
+    mask_name = entry.get("name") or _video_name(entry)
+    mask_path = entry.get("mask") or os.path.join(mask_dir, mask_name + ".npy")
+    if not os.path.exists(mask_path):
+        raise FileNotFoundError(f"No segmentation mask for {video_path}: {mask_path}")
+
+    center_point = entry.get("center")
+    if center_point is None:
+        center_point = mask_center_point(np.load(mask_path).astype(bool))
+
+    return dict(
+        name=name,
+        video=video_path,
+        mask=mask_path,
+        center=[int(c) for c in center_point],
+    )
+
+
+def load_finished_result(result_path, entry, pipeline_kwargs):
+    """
+    the result.json of an earlier run of the same entry (video, mask, center) with
+    the same pipeline_kwargs, or None when there is none or it differs
+    """
+    if not os.path.exists(result_path):
+        return None
+    with open(result_path) as f:
+        result = json.load(f)
+    same_entry = all(result.get(key) == value for key, value in entry.items())
+    if not same_entry or result.get("pipeline_kwargs") != pipeline_kwargs:
+        return None
+    return result
+
+
+def process_entry(entry, output_root, pipeline_kwargs):
+    """
+    runs the pipeline for one entry into output_root/<name>. result.json is written
+    last with the entry and pipeline_kwargs, so on restart an entry is skipped only
+    when it finished with exactly those, and rerun otherwise.
+    """
+    output_dir = os.path.join(output_root, entry["name"])
+    result_path = os.path.join(output_dir, "result.json")
+    result = load_finished_result(result_path, entry, pipeline_kwargs)
+    if result is not None:
+        return dict(result, status="skipped")
+
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        pipe = Pipeline(
+            entry["video"],
+            entry["mask"],
+            center_point=entry["center"],
+            output_dir=output_dir,
+            **pipeline_kwargs,
+        )
+        pipe.process_video_intensity()
+    except Exception as e:
+        traceback.print_exc()
+        return dict(entry, status="failed", error=repr(e))
+
+    result = dict(
+        entry,
+        pipeline_kwargs=pipeline_kwargs,
+        status="done",
+        heart_rate=float(pipe.heart_rate),
+        fps=float(pipe.fps),
+        n_frames=int(pipe.n_frames),
+        n_valid_patches=int(pipe.valid_mask.sum()),
+        elapsed=time.perf_counter() - start,
+    )
+    with open(result_path + ".tmp", "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(result_path + ".tmp", result_path)
+    return result
+
+
+def run_batch(entries, output_root, jobs=None, mask_dir=SEG_MASKS_DIR, **pipeline_kwargs):
+    """
+    summary.json lists every entry as done, skipped, failed (the pipeline raised)
+    or error (its worker died, e.g. killed for memory), and is written even when
+    the batch is interrupted
+    """
+    os.makedirs(output_root, exist_ok=True)
+
+    results = []
+    runnable = []
+    for entry, name in zip(entries, get_entry_names(entries)):
+        try:
+            runnable.append(resolve_entry(entry, mask_dir, name))
+        except Exception as e:
+            results.append(dict(entry, name=name, status="failed", error=repr(e)))
+
+    summary_path = os.path.join(output_root, "summary.json")
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(process_entry, entry, output_root, pipeline_kwargs): entry
+                for entry in runnable
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # BrokenProcessPool for this and every pending entry
+                    result = dict(futures[future], status="error", error=repr(e))
+                print(f"[{result['status']}] {result['name']}")
+                results.append(result)
+    finally:
+        with open(summary_path + ".tmp", "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(summary_path + ".tmp", summary_path)
+        print(f"Summary saved as {summary_path}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the heart rate pipeline headless on many videos."
+    )
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="A .json/.jsonl manifest, or video files whose masks are looked up by "
+        "name in --mask-dir",
+    )
+    parser.add_argument("--output", type=str, default="./out/batch")
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Videos processed in parallel"
+    )
+    parser.add_argument("--mask-dir", type=str, default=SEG_MASKS_DIR)
+    parser.add_argument(
+        "--temporal-method", choices=("fft", "tiled", "iir"), default="fft"
+    )
+    parser.add_argument(
+        "--no-zero-phase",
+        dest="zero_phase",
+        action="store_false",
+        help="Run the IIR band-pass forward only",
+    )
+    parser.add_argument("--patch-mode", choices=("grid", "quadtree"), default="grid")
+    parser.add_argument("--method", choices=RPPG_METHODS, default="pos")
+    parser.add_argument(
+        "--hr-tracking",
+        action="store_true",
+        help="Follow a changing heart rate (needs --temporal-method iir)",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Band-pass 3x3 patch means instead of every pixel (grid patches)",
+    )
+    parser.add_argument(
+        "--jit", action="store_true", help="Use the numba kernels if installed"
+    )
+    args = parser.parse_args()
+
+    if len(args.inputs) == 1 and args.inputs[0].endswith((".json", ".jsonl")):
+        entries = load_manifest(args.inputs[0])
+    else:
+        entries = [{"video": video_path} for video_path in args.inputs]
+
+    run_batch(
+        entries,
+        args.output,
+        jobs=args.jobs,
+        mask_dir=args.mask_dir,
+        temporal_method=args.temporal_method,
+        zero_phase=args.zero_phase,
+        patch_mode=args.patch_mode,
+        method=args.method,
+        hr_tracking=args.hr_tracking,
+        fused=args.fused,
+        jit=args.jit,
+    )
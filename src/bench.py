@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import cv2
+import numpy as np
+
+from constants import gaussian_kernel
+from extract import Pipeline
+from preproc import get_spatial_filtered_images, temporal_bp_filter
+from utils import load_video
+from visual import draw_box
+
+
+def make_synthetic_video(height, width, n_frames, fps, heart_rate=72.0, seed=0):
+    """
+    rgb video of a skin-coloured ellipse whose channels pulse at heart_rate with a
+    small phase delay across the frame, plus sensor noise. also returns the ellipse
+    as a segmentation mask.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:height, :width]
+    mask = ((yy - height / 2) / (0.4 * height)) ** 2 + (
+        (xx - width / 2) / (0.4 * width)
+    ) ** 2 <= 1
+
+    base = np.array([120, 100, 90], dtype=np.float32)
+    pulse_gain = np.array([-0.5, 1.0, 0.5], dtype=np.float32)
+    delay = 0.1 * xx / width  # seconds, grows left to right
+
+    video = np.empty((n_frames, height, width, 3), dtype=np.uint8)
+    for t in range(n_frames):
+        pulse = 3 * np.sin(2 * np.pi * heart_rate / 60 * (t / fps - delay))
+        frame = base + pulse[..., np.newaxis] * pulse_gain
+        frame += rng.normal(0, 1, frame.shape).astype(np.float32)
+        frame[~mask] = 20
+        video[t] = np.clip(frame, 0, 255)
+
+    return video, mask
+
+
+def write_synthetic_video(video, fps, video_path):
+    _, height, width, _ = video.shape
+    writer = cv2.VideoWriter(
+        video_path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height)
+    )
+    for frame in video:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    writer.release()
+
+
+def measure(func, repeat=1):
+    """
+    best wall / cpu time over repeat runs, then one extra run under tracemalloc for
+    the peak of traced (numpy and python) allocations
+    """
+    wall_times, cpu_times = [], []
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(wall=min(wall_times), cpu=min(cpu_times), peak_bytes=peak)
+
+
+def run_benchmarks(height, width, n_frames, fps, repeat=1, stages=None):
+    video, mask = make_synthetic_video(height, width, n_frames, fps)
+    work_dir = tempfile.mkdtemp(prefix="burn_depth_bench_")
+    video_path = os.path.join(work_dir, "synthetic.avi")
+    mask_path = os.path.join(work_dir, "mask.npy")
+    write_synthetic_video(video, fps, video_path)
+    np.save(mask_path, mask)
+
+    # one full run sets up every intermediate the stages below read
+    pipe = Pipeline(
+        video_path,
+        mask_path,
+        center_point=(height // 2, width // 2),
+        output_dir=work_dir,
+    )
+    heart_rate_freq = pipe.heart_rate / 60
+    freq_range = (heart_rate_freq - 0.15, heart_rate_freq + 0.15)
+    spatial_filtered_video = get_spatial_filtered_images(
+        pipe.video, gaussian_kernel, 3
+    )
+
+    benchmarks = {
+        "load_video": lambda: load_video(video_path),
+        "get_spatial_filtered_images": lambda: get_spatial_filtered_images(
+            pipe.video, gaussian_kernel, 3
+        ),
+        "temporal_bp_filter": lambda: temporal_bp_filter(
+            spatial_filtered_video, pipe.fps, freq_range
+        ),
+        "calc_signals_map": pipe.calc_signals_map,
+        "calc_valid_mask": pipe.calc_valid_mask,
+        "calc_time_delays": pipe.calc_time_delays,
+        "get_heatmap_video": pipe.get_heatmap_video,
+        "get_heatmap_video_intensity": pipe.get_heatmap_video_intensity,
+        "draw_box": lambda: draw_box(
+            pipe.video,
+            pipe.fps,
+            pipe.center_point,
+            pipe.window_size,
+            pipe.signal_ref,
+            os.path.join(work_dir, "boxed.mp4"),
+        ),
+    }
+
+    n_patches = int(pipe.patch_segmentation_mask.sum())
+    items = {
+        "calc_signals_map": n_patches,
+        "calc_valid_mask": n_patches,
+        "calc_time_delays": int(pipe.valid_mask.sum()),
+    }
+
+    results = {}
+    for name, func in benchmarks.items():
+        if stages and name not in stages:
+            continue
+        print(f"Benchmarking {name}")
+        try:
+            results[name] = dict(
+                measure(func, repeat), items=items.get(name, pipe.n_frames)
+            )
+        except Exception as e:
+            # keep going so one broken stage does not hide the others' numbers
+            tracemalloc.stop()
+            results[name] = dict(error=repr(e))
+
+    return dict(
+        config=dict(
+            height=height,
+            width=width,
+            n_frames=n_frames,
+            fps=fps,
+            repeat=repeat,
+            python=platform.python_version(),
+            numpy=np.__version__,
+            opencv=cv2.__version__,
+            cpu_count=os.cpu_count(),
+        ),
+        stages=results,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time and memory-profile each pipeline stage on a synthetic video."
+    )
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--stages", type=str, nargs="*", default=None, help="Only run these stages"
+    )
+    parser.add_argument("--output", type=str, default="./out/bench.json")
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.height, args.width, args.frames, args.fps, args.repeat, args.stages
+    )
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, stage in report["stages"].items():
+        if "error" in stage:
+            print(f"{name:32s} failed: {stage['error']}")
+            continue
+        print(
+            f"{name:32s} wall={stage['wall']:8.3f}s cpu={stage['cpu']:8.3f}s "
+            f"peak={stage['peak_bytes'] / 2**20:9.1f}MiB items={stage['items']}"
+        )
+    print(f"Benchmark results saved as {args.output}")
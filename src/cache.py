@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+# bump when a stage's output changes for the same parameters, orphaning old entries
+CACHE_VERSION = 3
+
+
+def hash_file(path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_array(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(str((array.shape, array.dtype.str)).encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+class ArrayCache:
+    """
+    content-addressed disk cache for intermediate arrays.
+
+    entries are .npy files named by a hash of everything that went into them (the
+    video hash, or the key of the stage they were computed from, plus the stage
+    parameters), so changing any parameter simply misses and computes a new entry.
+    hits are opened memory-mapped and read-only. once the cache grows past max_bytes
+    the least recently used entries are evicted. entries being written are .tmp
+    files, which count towards max_bytes and are removed once they have not been
+    modified for stale_seconds (left behind by a run that died before committing).
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 2**30, stale_seconds=24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        self.evict()
+
+    def key(self, *parts):
+        """
+        hashes json-able parts (numpy arrays are converted to lists) into a key
+        """
+        payload = json.dumps(
+            [CACHE_VERSION, *parts],
+            sort_keys=True,
+            default=lambda o: o.tolist() if hasattr(o, "tolist") else repr(o),
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used
+        print(f"Cache hit {key[:12]}")
+        return np.load(path, mmap_mode="r")
+
+    def put(self, key, array):
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp_path, self._path(key))
+        self.evict(keep=key)
+
+    def reserve(self, key, shape, dtype):
+        """
+        a writable memmap for a large stage output to be computed in place, which
+        becomes a cache entry on commit(key)
+        """
+        return np.lib.format.open_memmap(
+            self._path(key) + ".tmp", mode="w+", dtype=dtype, shape=shape
+        )
+
+    def commit(self, key, array):
+        """
+        publishes an array returned by reserve and returns it reopened read-only
+        """
+        array.flush()
+        os.replace(self._path(key) + ".tmp", self._path(key))
+        self.evict(keep=key)
+        return np.load(self._path(key), mmap_mode="r")
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.stale_seconds:
+                        os.remove(path)
+                    else:  # possibly still being written by another run
+                        total += stat.st_size
+                except FileNotFoundError:  # committed or removed meanwhile
+                    pass
+            elif name.endswith(".npy"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == f"{keep}.npy":
+                continue
+            # open memmaps keep working after unlink on posix
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
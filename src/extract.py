@@ -1,6 +1,6 @@
 import argparse
 import os
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 
 import cv2
 import matplotlib.pyplot as plt
@@ -9,13 +9,21 @@ from matplotlib.lines import segment_hits
 from scipy.signal import butter, csd, filtfilt, welch
 from skimage.restoration import unwrap_phase
 
+import accel
+from cache import ArrayCache, hash_array, hash_file
 from constants import gaussian_kernel
+from parallel import SharedArray, run_row_bands, share
+from patches import (get_grid_patches, get_quadtree_patches,
+                     get_rect_index_map)
+from profiling import StageRecorder
 from preproc import get_spatial_filtered_images, get_temporal_filtered_video
-from signals import (get_chrom_signal, get_green_signal, get_pca_signal,
-                     get_pos_signal)
-from utils import (load_video, select_center_point, select_segmenting_mask,
-                   write_video)
-from visual import draw_box
+from signals import (RPPG_METHODS, get_heart_rate_track, get_patch_means,
+                     get_roi_stats, get_rppg_signals, get_snr_map,
+                     get_time_delays)
+from utils import (load_video, load_video_memmap, select_center_point,
+                   select_segmenting_mask)
+from visual import (draw_box, get_colormap_lut, get_patch_index_map,
+                    iter_heatmap_frames)
 
 
 def bandpass_filter(signal, lowcut, highcut, fs, order=4):
@@ -28,10 +36,87 @@ def bandpass_filter(signal, lowcut, highcut, fs, order=4):
 
 
 class Pipeline:
-    def __init__(self, video_path, mask_path):
-        self.video, self.fps = load_video(video_path=video_path)
+    def __init__(
+        self,
+        video_path,
+        mask_path,
+        memmap_dir=None,
+        temporal_method="fft",
+        zero_phase=True,
+        processes=1,
+        center_point=None,
+        output_dir="./out",
+        profiler=None,
+        trace_allocations=False,
+        cache_dir=None,
+        patch_mode="grid",
+        max_patch_size=None,
+        method="pos",
+        hr_tracking=False,
+        fused=False,
+        jit=False,
+    ):
+        self.memmap_dir = memmap_dir
+        self.output_dir = output_dir
+        self.recorder = StageRecorder(
+            trace_allocations=trace_allocations,
+            profiler=profiler,
+            profile_dir=os.path.join(output_dir, "profiles"),
+            report_path=os.path.join(output_dir, "run_report.json"),
+        )
+        self.temporal_method = temporal_method
+        # the iir filter also runs backwards, so that its phase delay does not
+        # shift the patch signals the time delays are measured on
+        self.zero_phase = zero_phase
+        self.processes = processes or cpu_count()
+        with self.recorder.stage("load_video") as record:
+            if memmap_dir is not None:
+                os.makedirs(memmap_dir, exist_ok=True)
+                self.video, self.fps = load_video_memmap(
+                    video_path=video_path,
+                    memmap_path=os.path.join(memmap_dir, "video.npy"),
+                )
+            else:
+                self.video, self.fps = load_video(video_path=video_path)
+            record["items"] = len(self.video)
         self.n_frames, self.height, self.width, _ = self.video.shape
+        self.kernel = gaussian_kernel
+        self.pyramid_level = 3
+        self.alpha = 2  # TODO: check alpha
         self.window_size = 1 * 2 + 1
+
+        # "grid": window_size patches everywhere, "quadtree": patches from
+        # window_size up to max_patch_size, split where the SNR stays high
+        if patch_mode not in ("grid", "quadtree"):
+            raise ValueError(f"Unknown patch mode: {patch_mode}")
+        self.patch_mode = patch_mode
+        self.max_patch_size = max_patch_size or self.window_size * 16
+
+        if method not in RPPG_METHODS:
+            raise ValueError(f"Unknown rPPG method: {method}")
+        self.method = method
+
+        # follow the heart rate over time, and let the temporal band-pass follow it
+        if hr_tracking and temporal_method != "iir":
+            raise ValueError("Heart rate tracking needs the iir temporal filter")
+        self.hr_tracking = hr_tracking
+
+        # filter the patch means instead of the full video, which needs grid
+        # patches. chrom and green always do (see calc_signals_map)
+        if fused and patch_mode != "grid":
+            raise ValueError("Fused filtering needs grid patches")
+        self.fused = fused
+
+        # compiled per-patch kernels from accel, numpy when numba is missing. they
+        # only use numba's threads with processes=1, the pools fork
+        if jit and not accel.HAVE_NUMBA:
+            print("numba is not installed, using the numpy kernels")
+        self.jit = jit
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ArrayCache(cache_dir)
+            self.video_hash = hash_file(video_path)
         self.n_patches_h = self.height // self.window_size
         self.n_patches_w = self.width // self.window_size
 
@@ -48,76 +133,150 @@ class Pipeline:
             self.n_patches_h, self.window_size, self.n_patches_w, self.window_size
         )
         self.patch_segmentation_mask = mask_reshaped.all(axis=(1, 3))
+        if self.cache is not None:
+            self.mask_hash = hash_array(self.patch_segmentation_mask)
 
-        masked_image = self.video[0].copy()
-        masked_image[~self.segmentation_mask] = [0, 0, 0]
-        print(masked_image.shape)
-        self.center_point = select_center_point(np.array(masked_image))
+        if center_point is not None:
+            self.center_point = tuple(center_point)
+        else:
+            masked_image = self.video[0].copy()
+            masked_image[~self.segmentation_mask] = [0, 0, 0]
+            print(masked_image.shape)
+            self.center_point = select_center_point(np.array(masked_image))
 
-        print("Calculating heart rate")
-        self.calc_heart_rate()
-        print("Finsihed heart rate")
+        n_patches = int(self.patch_segmentation_mask.sum())
 
-        print("Calculating signal map")
-        self.calc_signals_map()
-        print("Finished signal map")
+        with self.recorder.stage("heart_rate", items=self.n_frames):
+            self.calc_heart_rate()
 
-        print("Calculating valid mask")
-        self.calc_valid_mask()
-        print("Finsihed valid mask")
+        with self.recorder.stage("signals_map", items=n_patches) as record:
+            self.calc_signals_map()
+            n_patches = len(self.patches)
+            record["items"] = n_patches
 
-        print("Calculating signal ref")
-        self.calc_signal_ref()
-        print("FInsih signal ref")
+        with self.recorder.stage("valid_mask", items=n_patches):
+            self.calc_valid_mask()
 
-        # print("Calculating timedelay")
-        # self.calc_time_delays()
-        # print("FInsih timedelay")
+        with self.recorder.stage("signal_ref"):
+            self.calc_signal_ref()
 
-    @staticmethod
-    def init_pool_processes(filtered_video_, window_size_):
-        global filtered_video
-        global window_size
-        filtered_video = filtered_video_
-        window_size = window_size_
+        with self.recorder.stage("time_delays") as record:
+            record["items"] = int(self.valid_mask.sum())
+            self.calc_time_delays()
 
-    @staticmethod
-    def process_patch(args):
-        i, j = args
-        patch_images = filtered_video[
-            :,
-            i * window_size : (i + 1) * window_size,
-            j * window_size : (j + 1) * window_size,
-            :,
-        ]
-        result = get_pos_signal(patch_images)
-        return (i, j, result)
-
-    def filter_video(self, freq_range):
-        spatial_filtered_video = get_spatial_filtered_images(
-            self.video, gaussian_kernel, 3
+    def _cache_keys(self, freq_range):
+        """
+        cache keys of the spatially filtered video, the temporally filtered video and
+        s_list, each chained on the key of the stage it is computed from
+        """
+        spatial_key = self.cache.key(
+            self.video_hash, "spatial", self.kernel, self.pyramid_level
+        )
+        temporal_key = self.cache.key(
+            spatial_key,
+            "temporal",
+            freq_range,
+            self.temporal_method,
+            self.zero_phase,
+            self.alpha,
         )
-        print("applying temporal filter")
-        filtered_video = get_temporal_filtered_video(
-            spatial_filtered_video, self.fps, freq_range, alpha=2, attenuation=1
-        )  # TODO: check alpha
+        signals_key = self.cache.key(
+            temporal_key, "s_list", self.window_size, self.mask_hash, self.method
+        )
+        return spatial_key, temporal_key, signals_key
+
+    def _stage_output(self, name, key=None, out=None):
+        """
+        where a full-size float32 stage output is written: a new cache entry, a memmap
+        in memmap_dir, or out (None lets the stage allocate it)
+        """
+        if key is not None:
+            return self.cache.reserve(key, self.video.shape, np.float32)
+        if self.memmap_dir is not None:
+            return np.lib.format.open_memmap(
+                os.path.join(self.memmap_dir, f"{name}.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=self.video.shape,
+            )
+        return out
+
+    def spatial_filter_video(self, spatial_key=None):
+        """
+        the spatially filtered video, cached under spatial_key
+        """
+        with self.recorder.stage("spatial_filter", items=self.n_frames):
+            spatial_filtered_video = None
+            if spatial_key is not None:
+                spatial_filtered_video = self.cache.get(spatial_key)
+            if spatial_filtered_video is None:
+                spatial_filtered_video = get_spatial_filtered_images(
+                    self.video,
+                    self.kernel,
+                    self.pyramid_level,
+                    out=self._stage_output("spatial", spatial_key),
+                )
+                if spatial_key is not None:
+                    spatial_filtered_video = self.cache.commit(
+                        spatial_key, spatial_filtered_video
+                    )
+        return spatial_filtered_video
+
+    def filter_video(self, freq_range, out=None):
+        spatial_key = temporal_key = None
+        if self.cache is not None:
+            spatial_key, temporal_key, _ = self._cache_keys(freq_range)
+            filtered_video = self.cache.get(temporal_key)
+            if filtered_video is not None:
+                return filtered_video
+
+        spatial_filtered_video = self.spatial_filter_video(spatial_key)
+
+        temporal_out = self._stage_output("temporal", temporal_key, out)
+        if (
+            temporal_out is None
+            and spatial_key is None
+            and self.temporal_method == "tiled"
+        ):
+            # the spatially filtered video is not needed afterwards, filter it in place
+            temporal_out = spatial_filtered_video
+
+        with self.recorder.stage("temporal_filter", items=self.n_frames):
+            filtered_video = get_temporal_filtered_video(
+                spatial_filtered_video,
+                self.fps,
+                freq_range,
+                alpha=self.alpha,
+                attenuation=1,
+                method=self.temporal_method,
+                zero_phase=self.zero_phase,
+                out=temporal_out,
+            )
+            if temporal_key is not None:
+                filtered_video = self.cache.commit(temporal_key, filtered_video)
         return filtered_video
 
     def calc_valid_mask(self):
         heart_rate_freq = self.heart_rate / 60  # in Hz
         heart_rate_range = (heart_rate_freq - 0.15, heart_rate_freq + 0.15)
 
-        snr_all = np.zeros((self.n_patches_h, self.n_patches_w))
-
-        valid_indices = np.where(self.patch_segmentation_mask)
-        for i, j in zip(valid_indices[0], valid_indices[1]):
-            snr_all[i, j] = self.get_snr(
-                self.s_list[i, j, :], self.fps, heart_rate_range
+        if self.jit:
+            snr, n_degenerate = accel.get_snr_map(
+                self.s_list, self.fps, heart_rate_range, parallel=self.processes == 1
             )
-
+        else:
+            snr, n_degenerate = get_snr_map(self.s_list, self.fps, heart_rate_range)
+        if n_degenerate:
+            print(f"Noise or signal power is 0 for {n_degenerate} patches")
+
+        # grid patches outside the mask have always entered the threshold as 0 dB
+        n_outside = 0
+        if self.patch_mode == "grid":
+            n_outside = self.patch_segmentation_mask.size - len(snr)
+        snr_all = np.concatenate((snr, np.zeros(n_outside)))
         threshold = np.nanmean(snr_all) - 2 * np.nanstd(snr_all)
 
-        self.valid_mask = (snr_all > threshold) & (~np.isnan(snr_all))
+        self.valid_mask = (snr > threshold) & (~np.isnan(snr))
 
     def calc_signal_ref(self, neighborhood_size=1):
         center_i = self.center_point[0] // self.window_size
@@ -128,14 +287,12 @@ class Pipeline:
         j_start = max(center_j - neighborhood_size, 0)
         j_end = min(center_j + neighborhood_size + 1, self.n_patches_w)
 
-        valid_signals = []
-
-        for i in range(i_start, i_end):
-            for j in range(j_start, j_end):
-                if self.patch_segmentation_mask[i, j]:
-                    valid_signals.append(self.s_list[i, j, :])
+        # the patches covering the neighbourhood, in patch order
+        rows = self.patch_grid_index()[i_start:i_end, j_start:j_end]
+        rows = np.unique(rows[rows < len(self.patches)])
+        valid_signals = self.s_list[rows].astype(np.float64)
 
-        if not valid_signals:
+        if len(valid_signals) == 0:
             raise ValueError("No valid neighboring patches found for signal reference.")
 
         signal_ref = np.mean(valid_signals, axis=0)
@@ -151,7 +308,19 @@ class Pipeline:
         self.signal_ref = signal_ref
 
     def calc_heart_rate(self):
-        signal = get_pos_signal(  # NOTE: Chrom might work better
+        heart_rate_key = None
+        # the track is not cached, it costs no more than the heart rate itself
+        if self.cache is not None and not self.hr_tracking:
+            heart_rate_key = self.cache.key(
+                self.video_hash, "heart_rate", self.center_point, self.method
+            )
+            heart_rate = self.cache.get(heart_rate_key)
+            if heart_rate is not None:
+                self.heart_rate = float(heart_rate)
+                print("guessed bpm=", self.heart_rate)
+                return
+
+        roi_stats = get_roi_stats(
             self.video[
                 :,
                 self.center_point[0] - 10 : self.center_point[0] + 10,
@@ -159,17 +328,12 @@ class Pipeline:
                 :,
             ]
         )
+        signal = get_rppg_signals(roi_stats, [self.method])[self.method]
 
-        freq_range = (0.5, 3.333)
         b, a = butter(3, [0.7/(self.fps/2), 4.0/(self.fps/2)], btype='band')
         signal_bp = filtfilt(b, a, signal)
         freqs, psd = welch(signal_bp, fs=self.fps, nperseg=256)
 
-        # mask = (freqs >= freq_range[0]) & (freqs <= freq_range[1])
-
-        # freqs = freqs[mask]
-        # psd = psd[mask]
-
         if len(freqs) == 0:
             raise ValueError("No frequencies found in the specified range.")
 
@@ -184,256 +348,486 @@ class Pipeline:
         plt.ylabel("Power Spectral Density")
         plt.grid()
         plt.legend()
-        plt.savefig("./out/psd.png")
+        plt.savefig(os.path.join(self.output_dir, "psd.png"))
+        plt.close()
 
         self.heart_rate = prominent_freq * 60
         # self.heart_rate = 70
         print("guessed bpm=", self.heart_rate)
 
-    def get_snr(self, signal, fs, freq_range):
-        N = len(signal)
-        freq_domain = np.fft.fft(signal)
-        freqs = np.fft.fftfreq(N, d=1 / fs)
+        if heart_rate_key is not None:
+            self.cache.put(heart_rate_key, np.array(self.heart_rate))
+
+        if self.hr_tracking:
+            self.calc_heart_rate_track(signal_bp)
+
+    def calc_heart_rate_track(self, signal_bp):
+        """
+        heart_rate_track: (n_frames,) BPM from overlapping windows of the band-passed
+        rPPG signal, interpolated to every frame. heart_rate becomes its median.
+        """
+        times, bpm = get_heart_rate_track(signal_bp, self.fps)
+        frame_times = np.arange(self.n_frames) / self.fps
+        self.heart_rate_track = np.interp(frame_times, times, bpm)
+        self.heart_rate = float(np.median(bpm))
+        print(
+            f"tracked bpm from {bpm.min():.1f} to {bpm.max():.1f}, "
+            f"median {self.heart_rate:.1f}"
+        )
+
+        plt.figure(figsize=(10, 6))
+        plt.plot(times, bpm)
+        plt.title("Heart Rate")
+        plt.xlabel("Time (s)")
+        plt.ylabel("BPM")
+        plt.grid()
+        plt.savefig(os.path.join(self.output_dir, "heart_rate.png"))
+        plt.close()
 
-        pos_mask = freqs >= 0
-        freqs = freqs[pos_mask]
-        freq_domain = freq_domain[pos_mask]
+    @staticmethod
+    def _signals_map_band(
+        start,
+        end,
+        filtered_video,
+        s_list,
+        patch_segmentation_mask,
+        window_size,
+        row_offsets,
+        method,
+        jit=False,
+    ):
+        band_mask = patch_segmentation_mask[start:end]
+        patch_means = get_patch_means(
+            filtered_video[:, start * window_size : end * window_size], window_size
+        )
+        masked_means = patch_means[:, band_mask]  # (T, n_valid, 3)
+        rppg_signals = accel.get_rppg_signals if jit else get_rppg_signals
+        s_list[row_offsets[start] : row_offsets[end]] = rppg_signals(
+            masked_means.transpose(1, 0, 2), [method]
+        )[method]
+
+    def _compute_signals_map(self, filter_range):
+        # patches are stored in row-major order, so a band of grid rows is a
+        # contiguous range of them
+        row_offsets = np.concatenate(
+            ([0], np.cumsum(self.patch_segmentation_mask.sum(axis=1)))
+        )
+        s_list = np.zeros((row_offsets[-1], self.n_frames), dtype=np.float32)
+
+        if self.processes == 1:
+            filtered_video = self.filter_video(filter_range)
+            self._signals_map_band(
+                0,
+                self.n_patches_h,
+                filtered_video,
+                s_list,
+                patch_segmentation_mask=self.patch_segmentation_mask,
+                window_size=self.window_size,
+                row_offsets=row_offsets,
+                method=self.method,
+                jit=self.jit,
+            )
+        else:
+            # filter straight into shared memory (or an on-disk memmap) so the
+            # workers read the one filtered video instead of a copy each
+            shared_video = None
+            if self.memmap_dir is None and self.cache is None:
+                shared_video = SharedArray(self.video.shape, np.float32)
+                filtered_video = self.filter_video(filter_range, shared_video.array)
+            else:
+                filtered_video = self.filter_video(filter_range)
+                shared_video = share(filtered_video)
+
+            with shared_video, SharedArray.from_array(s_list) as shared_s_list:
+                run_row_bands(
+                    self._signals_map_band,
+                    self.n_patches_h,
+                    (shared_video, shared_s_list),
+                    processes=self.processes,
+                    patch_segmentation_mask=self.patch_segmentation_mask,
+                    window_size=self.window_size,
+                    row_offsets=row_offsets,
+                    method=self.method,
+                    jit=self.jit,
+                )
+                s_list = shared_s_list.array.copy()
 
-        power_spectrum = np.abs(freq_domain) ** 2 / N
+        return s_list
 
-        signal_mask = (freqs >= freq_range[0]) & (freqs <= freq_range[1])
-        signal_power = np.sum(power_spectrum[signal_mask])
+    def _band_pass_statistics(self, statistics, filter_range):
+        """
+        band-passes (T, ...) patch statistics in place, like filter_video does the
+        pixels
+        """
+        with self.recorder.stage("temporal_filter", items=self.n_frames):
+            return get_temporal_filtered_video(
+                statistics,
+                self.fps,
+                filter_range,
+                alpha=self.alpha,
+                attenuation=1,
+                method=self.temporal_method,
+                zero_phase=self.zero_phase,
+                out=statistics,
+            )
+
+    def _compute_fused_signals_map(self, filter_range):
+        """
+        s_list from the patch statistics of every spatially filtered frame,
+        band-passed at patch resolution. the temporal filter is linear and per
+        pixel, so it commutes with the patch means: the signals are those of
+        filter_video, without holding or band-passing the full-resolution video.
+        chrom and green take the means of the normalized rgb of these frames.
+        """
+        with self.recorder.stage("spatial_filter", items=self.n_frames):
+            patch_means = get_spatial_filtered_images(
+                self.video,
+                self.kernel,
+                self.pyramid_level,
+                window_size=self.window_size,
+                chromaticity=self.method in ("chrom", "green"),
+            )
 
-        noise_mask = ~signal_mask
-        noise_power = np.sum(power_spectrum[noise_mask])
+        filtered_means = self._band_pass_statistics(patch_means, filter_range)
 
-        if noise_power == 0 or signal_power == 0:
-            print("Noise or signal power is 0")
-            snr = np.nan
+        masked_means = filtered_means[:, self.patch_segmentation_mask]
+        if self.jit:
+            rppg_signals = accel.get_rppg_signals(
+                masked_means.transpose(1, 0, 2),
+                [self.method],
+                parallel=self.processes == 1,
+            )
         else:
-            snr = 10 * np.log10(signal_power / noise_power)
-        return snr
+            rppg_signals = get_rppg_signals(
+                masked_means.transpose(1, 0, 2), [self.method]
+            )
+        return rppg_signals[self.method]
 
     def calc_signals_map(self):
         """
-        returns a map of all signals specified by the window_size in the entire video.
+        computes one signal per patch inside the segmentation mask: s_list is a
+        float32 (n_patches, n_frames) array and patches the (n_patches, 4) rects
+        (y, x, height, width) of its rows. use scatter_to_grid / scatter_to_pixels
+        for per-patch results in image layout.
         """
         heart_rate_freq = self.heart_rate / 60  # in Hz
         heart_rate_range = (heart_rate_freq - 0.15, heart_rate_freq + 0.15)
-        filtered_video = self.filter_video(heart_rate_range)
-        s_list = np.zeros((self.n_patches_h, self.n_patches_w, self.n_frames))
-        tasks = [
-            (i, j)
-            for i in range(self.n_patches_h)
-            for j in range(self.n_patches_w)
-            if self.patch_segmentation_mask[i, j]
-        ]
-
-        with Pool(
-            initializer=self.init_pool_processes,
-            initargs=(filtered_video, self.window_size),
-            processes=cpu_count(),
-        ) as pool:
-            results = pool.map(self.process_patch, tasks)
-        for i, j, result in results:
-            # s_list[i, j, :] = bandpass_filter(result, self.heart_rate/60 -0.15, self.heart_rate/60+0.15, self.fps)
-            s_list[i, j, :] = result
-        self.s_list = s_list
-
-        amplitude_map = np.mean(np.abs(s_list), axis=2)
+        filter_range = heart_rate_range
+        if self.hr_tracking:
+            # the same band around the tracked heart rate of every frame
+            track_freq = self.heart_rate_track / 60
+            filter_range = np.column_stack((track_freq - 0.15, track_freq + 0.15))
+
+        if self.patch_mode == "quadtree":
+            self._calc_quadtree_signals(filter_range, heart_rate_range)
+            amplitude_map = self.scatter_to_pixels(
+                np.mean(np.abs(self.s_list), axis=-1), fill=np.nan
+            )
+            x_label, y_label = "Width", "Height"
+        else:
+            # chrom and green always band-pass the patch statistics, see
+            # get_rppg_signals
+            fused = self.fused or self.method in ("chrom", "green")
+            s_list = signals_key = None
+            if self.cache is not None:
+                signals_key = self._cache_keys(filter_range)[2]
+                if fused:
+                    signals_key = self.cache.key(signals_key, "fused")
+                s_list = self.cache.get(signals_key)
+            if s_list is None:
+                if fused:
+                    s_list = self._compute_fused_signals_map(filter_range)
+                else:
+                    s_list = self._compute_signals_map(filter_range)
+                if signals_key is not None:
+                    self.cache.put(signals_key, s_list)
+            self.s_list = s_list
+            self.patches = get_grid_patches(
+                self.n_patches_h, self.n_patches_w, self.window_size
+            )[self.patch_segmentation_mask.flatten()]
+            amplitude_map = self.scatter_to_grid(
+                np.mean(np.abs(s_list), axis=-1, dtype=np.float64)
+            )
+            x_label, y_label = "Width Patches", "Height Patches"
 
         plt.figure(figsize=(10, 8))
         plt.imshow(amplitude_map, cmap="viridis", interpolation="nearest")
         plt.colorbar(label="Amplitude")
         plt.title("Amplitude Map")
-        plt.xlabel("Width Patches")
-        plt.ylabel("Height Patches")
-        plt.savefig("./out/amplitude.png")
+        plt.xlabel(x_label)
+        plt.ylabel(y_label)
+        plt.savefig(os.path.join(self.output_dir, "amplitude.png"))
+        plt.close()
 
-    @staticmethod
-    def init_pool_processes_time_delay(s_list_, signal_ref_, fps_, max_lag_frames_):
-        global s_list
-        global signal_ref
-        global fps
-        global max_lag_frames
-        s_list = s_list_
-        signal_ref = signal_ref_
-        fps = fps_
-        max_lag_frames = max_lag_frames_
+    def _calc_quadtree_signals(self, filter_range, heart_rate_range):
+        """
+        sets patches (n, 4) rects and s_list (n, T) from get_quadtree_patches. every
+        patch lies inside the segmentation mask. the block statistics of the
+        spatially filtered video are band-passed to filter_range, the SNR of the
+        blocks is measured in heart_rate_range.
+        """
+        patches = s_list = spatial_key = None
+        if self.cache is not None:
+            spatial_key, temporal_key, _ = self._cache_keys(filter_range)
+            signals_key = self.cache.key(
+                temporal_key,
+                "s_list",
+                "quadtree",
+                self.window_size,
+                self.max_patch_size,
+                hash_array(self.segmentation_mask),
+                self.method,
+            )
+            patches_key = self.cache.key(signals_key, "patches")
+            s_list = self.cache.get(signals_key)
+            patches = self.cache.get(patches_key)
+        if s_list is None or patches is None:
+            patches, s_list = get_quadtree_patches(
+                self.spatial_filter_video(spatial_key),
+                self.segmentation_mask,
+                self.fps,
+                heart_rate_range,
+                min_size=self.window_size,
+                max_size=self.max_patch_size,
+                method=self.method,
+                temporal_filter=lambda means: self._band_pass_statistics(
+                    means, filter_range
+                ),
+            )
+            if self.cache is not None:
+                self.cache.put(signals_key, s_list)
+                self.cache.put(patches_key, patches)
 
-    @staticmethod
-    def _compute_time_delay(args):
-        i, j = args
-        s_patch = s_list[i, j, :]
-
-        s_patch_centered = s_patch - np.mean(s_patch)
-        signal_ref_centered = signal_ref - np.mean(signal_ref)
-        correlation = np.correlate(s_patch_centered, signal_ref_centered, mode="full")
-        N = len(s_patch)
-        lags = np.arange(-N + 1, N)
-        lag_mask = np.abs(lags) <= max_lag_frames
-        correlation = correlation[lag_mask]
-        lags = lags[lag_mask]
-        if correlation.size == 0:
-            delta_t = np.nan
-        else:
-            max_corr_index = np.argmax(correlation)
-            max_lag = lags[max_corr_index]
-            delta_t = max_lag / fps
+        print(f"{len(patches)} quadtree patches")
+        self.patches = np.asarray(patches)
+        self.s_list = s_list
 
-        return (i, j, delta_t)
+    def patch_grid_index(self):
+        """
+        (n_patches_h, n_patches_w) map from window_size grid cells to the patch
+        covering them, len(patches) where there is none
+        """
+        if self.patch_mode == "quadtree":
+            index_map = get_rect_index_map(self.patches, self.height, self.width)
+            cell_centers = index_map[
+                self.window_size // 2 :: self.window_size,
+                self.window_size // 2 :: self.window_size,
+            ]
+            return cell_centers[: self.n_patches_h, : self.n_patches_w]
+        grid_index = np.full(self.patch_segmentation_mask.shape, len(self.patches))
+        grid_index[self.patch_segmentation_mask] = np.arange(len(self.patches))
+        return grid_index
 
-    def calc_time_delays(self):
-        time_delays = np.zeros((self.n_patches_h, self.n_patches_w))
-        indices = [
-            (i, j)
-            for i in range(self.n_patches_h)
-            for j in range(self.n_patches_w)
-            if self.valid_mask[i, j]
-        ]
+    def patch_index_map(self):
+        """
+        (height, width) map from pixels to the patch covering them, len(patches)
+        where there is none
+        """
+        if self.patch_mode == "quadtree":
+            return get_rect_index_map(self.patches, self.height, self.width)
+        index_map = get_patch_index_map(
+            self.n_patches_h,
+            self.n_patches_w,
+            self.window_size,
+            self.height,
+            self.width,
+        )
+        grid_index = np.append(self.patch_grid_index().flatten(), len(self.patches))
+        return grid_index[index_map]
 
-        max_lag_seconds = 0.34
-        max_lag_frames = int(max_lag_seconds * self.fps)
+    def scatter_to_grid(self, patch_values, fill=0):
+        """
+        (n_patches_h, n_patches_w, ...) array of per-patch values (n_patches, ...),
+        fill where there is no patch
+        """
+        patch_values = np.asarray(patch_values)
+        fill = np.full((1,) + patch_values.shape[1:], fill, dtype=patch_values.dtype)
+        return np.concatenate((patch_values, fill))[self.patch_grid_index()]
 
-        with Pool(
-            processes=cpu_count(),
-            initializer=self.init_pool_processes_time_delay,
-            initargs=(self.s_list, self.signal_ref, self.fps, max_lag_frames),
-        ) as pool:
-            results = pool.map(self._compute_time_delay, indices)
+    def scatter_to_pixels(self, patch_values, fill=0):
+        """
+        (height, width) image of one value per patch, fill where there is no patch
+        """
+        return np.append(patch_values, fill)[self.patch_index_map()]
 
-        for i, j, delta_t in results:
-            time_delays[i, j] = delta_t
+    @staticmethod
+    def _time_delays_band(
+        start,
+        end,
+        s_list,
+        time_delays,
+        valid_mask,
+        signal_ref,
+        fps,
+        jit=False,
+        **kwargs,
+    ):
+        band_mask = valid_mask[start:end]
+        time_delays_fn = accel.get_time_delays if jit else get_time_delays
+        time_delays[start:end][band_mask] = time_delays_fn(
+            s_list[start:end][band_mask], signal_ref, fps, **kwargs
+        )
 
-        self.time_delays = time_delays
+    def calc_time_delays(self, interpolate=True):
+        time_delays = np.zeros(self.valid_mask.shape)
 
-    def get_heatmap_video_intensity(self):
-        heatmaps = np.zeros((self.n_frames, self.height, self.width), dtype=np.float32)
-
-        for i in range(self.n_patches_h):
-            for j in range(self.n_patches_w):
-                y_start, y_end = i * self.window_size, (i + 1) * self.window_size
-                x_start, x_end = j * self.window_size, (j + 1) * self.window_size
-                heatmaps[:, y_start:y_end, x_start:x_end] = self.s_list[i, j].reshape(
-                    -1, 1, 1
+        max_lag_seconds = 0.34
+        max_lag_frames = int(max_lag_seconds * self.fps)
+
+        band_kwargs = dict(
+            valid_mask=self.valid_mask,
+            signal_ref=self.signal_ref,
+            fps=self.fps,
+            max_lag_frames=max_lag_frames,
+            interpolate=interpolate,
+            jit=self.jit,
+        )
+        if self.processes == 1:
+            self._time_delays_band(
+                0, len(self.valid_mask), self.s_list, time_delays, **band_kwargs
+            )
+        else:
+            with SharedArray.from_array(self.s_list) as shared_s_list, SharedArray(
+                time_delays.shape, time_delays.dtype
+            ) as shared_time_delays:
+                run_row_bands(
+                    self._time_delays_band,
+                    len(self.valid_mask),
+                    (shared_s_list, shared_time_delays),
+                    processes=self.processes,
+                    **band_kwargs,
                 )
+                time_delays = shared_time_delays.array.copy()
+
+        self.time_delays = time_delays
 
-        heatmaps_normalized = (heatmaps / np.max(heatmaps)) * 255.0
-        heatmaps_normalized = heatmaps_normalized.astype(np.uint8)
+    def iter_heatmap_video_intensity(self):
+        """
+        yields the rgb heatmap of s_list one frame at a time
+        """
+        s_list = self.s_list
+        index_map = self.patch_index_map()
+
+        # the max is over pixels, which includes the zeros where there is no patch
+        max_value = np.max(s_list).astype(np.float32)
+        if np.any(index_map == len(s_list)):
+            max_value = max(max_value, np.float32(0))
+
+        def patch_values():
+            for t in range(self.n_frames):
+                values = (s_list[:, t].astype(np.float32) / max_value) * 255.0
+                yield values.astype(np.uint8)
+
+        return self._heatmap_frames(patch_values(), index_map)
+
+    def _heatmap_frames(self, patch_values, index_map):
+        if self.jit:
+            return accel.iter_heatmap_frames(
+                patch_values,
+                index_map,
+                get_colormap_lut(),
+                parallel=self.processes == 1,
+            )
+        return iter_heatmap_frames(patch_values, index_map, get_colormap_lut())
 
+    def get_heatmap_video_intensity(self):
         heatmap_frames = np.empty(
             (self.n_frames, self.height, self.width, 3), dtype=np.uint8
         )
-        for t in range(self.n_frames):
-            heatmap_color = cv2.applyColorMap(heatmaps_normalized[t], cv2.COLORMAP_JET)
-            heatmap_frames[t] = cv2.cvtColor(heatmap_color, cv2.COLOR_BGR2RGB)
-
+        for t, frame in enumerate(self.iter_heatmap_video_intensity()):
+            heatmap_frames[t] = frame
         return heatmap_frames
 
-    def get_heatmap_video(self):
-        patch_height = self.height // self.n_patches_h
-        patch_width = self.width // self.n_patches_w
-
-        i_indices, j_indices = np.meshgrid(
-            np.arange(self.n_patches_h), np.arange(self.n_patches_w), indexing="ij"
-        )
-        y_start = (i_indices * patch_height).flatten()
-        y_end = ((i_indices + 1) * patch_height).flatten()
-        x_start = (j_indices * patch_width).flatten()
-        x_end = ((j_indices + 1) * patch_width).flatten()
+    def iter_heatmap_video(self):
+        """
+        yields the rgb heatmap of signal_ref shifted by each patch's time delay one
+        frame at a time
+        """
+        index_map = self.patch_index_map()
 
-        valid_segments = (self.valid_mask & self.patch_segmentation_mask).flatten()
+        valid_segments = self.valid_mask
 
-        sample_indices = (self.time_delays.flatten() * self.fps).astype(int)
+        sample_indices = np.rint(self.time_delays * self.fps).astype(int)
         sample_indices = sample_indices % len(self.signal_ref)
 
-        frame_indices = np.arange(self.n_frames).reshape(-1, 1)  # (n_frames, 1)
-        sample_indices_matrix = (frame_indices + sample_indices) % len(self.signal_ref)
-        amplitudes = self.signal_ref[sample_indices_matrix]
-
-        amplitudes[:, ~valid_segments] = 0
+        def patch_values():
+            for t in range(self.n_frames):
+                amplitudes = self.signal_ref[
+                    (t + sample_indices) % len(self.signal_ref)
+                ].astype(np.float32)
+                amplitudes[~valid_segments] = 0
+                yield (np.clip(amplitudes, 0.0, 1.0) * 255.0).astype(np.uint8)
 
-        heatmaps = np.zeros((self.n_frames, self.height, self.width), dtype=np.float32)
-
-        for idx in range(len(y_start)):
-            y_start = y_start[idx]
-            y_end = y_end[idx]
-            x_start = x_start[idx]
-            x_end = x_end[idx]
-            heatmaps[:, y_start:y_end, x_start:x_end] = amplitudes[
-                :, idx, np.newaxis, np.newaxis
-            ]
-
-        heatmaps_normalized = np.clip(heatmaps, 0.0, 1.0) * 255.0
-        heatmaps_normalized = heatmaps_normalized.astype(np.uint8)
+        return self._heatmap_frames(patch_values(), index_map)
 
+    def get_heatmap_video(self):
         heatmap_frames = np.empty(
             (self.n_frames, self.height, self.width, 3), dtype=np.uint8
         )
-        for t in range(self.n_frames):
-            heatmap_color = cv2.applyColorMap(heatmaps_normalized[t], cv2.COLORMAP_JET)
-            heatmap_color_rgb = cv2.cvtColor(heatmap_color, cv2.COLOR_BGR2RGB)
-            heatmap_frames[t] = heatmap_color_rgb
-
+        for t, frame in enumerate(self.iter_heatmap_video()):
+            heatmap_frames[t] = frame
         return heatmap_frames
 
+    def iter_overlaid_frames(self, heatmap_frames):
+        """
+        yields each video frame with its heatmap frame pasted over it where the
+        heatmap is not dark blue and inside the segmentation mask
+        """
+        for frame, heatmap in zip(self.video, heatmap_frames):
+            red_normalized = heatmap[..., 0].astype(np.float32) / 255.0
+            mask = self.segmentation_mask & (red_normalized > 0.05)
+            overlaid_frame = np.array(frame)
+            overlaid_frame[mask] = heatmap[mask]
+            yield overlaid_frame
+
     def process_video_time_delays(self):
+        time_delays = self.time_delays
+        if self.patch_mode == "grid":
+            time_delays = self.scatter_to_grid(time_delays)
 
-        min_delay = np.nanmin(self.time_delays)
-        max_delay = np.nanmax(self.time_delays)
+        min_delay = np.nanmin(time_delays)
+        max_delay = np.nanmax(time_delays)
 
         if max_delay - min_delay == 0:
-            normalized_delays = np.zeros_like(self.time_delays, dtype=np.uint8)
+            normalized_delays = np.zeros_like(time_delays, dtype=np.uint8)
         else:
-            normalized_delays = (self.time_delays - min_delay) / (max_delay - min_delay)
+            normalized_delays = (time_delays - min_delay) / (max_delay - min_delay)
             normalized_delays = (normalized_delays * 255).astype(np.uint8)
 
-        jet_colormap = cv2.applyColorMap(normalized_delays, cv2.COLORMAP_JET)
-        jet_colormap = cv2.resize(
-            jet_colormap, (self.width, self.height), interpolation=cv2.INTER_LINEAR
-        )
-        cv2.imwrite("./out/PTT.png", jet_colormap)
-
-        print("getting heatmap frames")
-        heatmap_frames = self.get_heatmap_video()
-        print("finish getting heatmap frames")
-        heatmap_float = heatmap_frames.astype(np.float32)
-        red_channel = heatmap_float[..., 0]  # (n_frames, height, width)
-        red_normalized = red_channel / 255.0
-        mask = red_normalized > 0.05
-        combined_mask = self.segmentation_mask & mask  # (n_frames, height, width)
-        mask = combined_mask[..., np.newaxis].repeat(3, axis=-1)  # add channel dim
-        overlaid_video = np.where(mask, heatmap_frames, self.video)
-
-        boxed_video = draw_box(
-            overlaid_video,
-            self.fps,
-            self.center_point,
-            self.window_size,
-            self.signal_ref,
-        )
-        write_video(boxed_video, self.fps, "./out/heatmap.avi")
+        if self.patch_mode == "quadtree":
+            jet_colormap = cv2.applyColorMap(
+                self.scatter_to_pixels(normalized_delays).astype(np.uint8),
+                cv2.COLORMAP_JET,
+            )
+        else:
+            jet_colormap = cv2.applyColorMap(normalized_delays, cv2.COLORMAP_JET)
+            jet_colormap = cv2.resize(
+                jet_colormap, (self.width, self.height), interpolation=cv2.INTER_LINEAR
+            )
+        cv2.imwrite(os.path.join(self.output_dir, "PTT.png"), jet_colormap)
+
+        # heatmap, composite, annotation and encoding run one frame at a time
+        with self.recorder.stage("render", items=self.n_frames):
+            draw_box(
+                self.iter_overlaid_frames(self.iter_heatmap_video()),
+                self.fps,
+                self.center_point,
+                self.window_size,
+                self.signal_ref,
+                os.path.join(self.output_dir, "heatmap.avi"),
+                fourcc="MJPG",
+            )
 
     def process_video_intensity(self):
-        print("getting heatmap frames")
-        heatmap_frames = self.get_heatmap_video_intensity()
-        print("finish getting heatmap frames")
-        heatmap_float = heatmap_frames.astype(np.float32)
-        red_channel = heatmap_float[..., 0]  # (n_frames, height, width)
-        red_normalized = red_channel / 255.0
-        mask = red_normalized > 0.05
-        combined_mask = self.segmentation_mask & mask  # (n_frames, height, width)
-        mask = combined_mask[..., np.newaxis].repeat(3, axis=-1)  # add channel dim
-        overlaid_video = np.where(mask, heatmap_frames, self.video)
-
-        draw_box(
-            overlaid_video,
-            self.fps,
-            self.center_point,
-            self.window_size,
-            self.signal_ref,
-            "./out/heatmap.avi",
-        )
+        with self.recorder.stage("render", items=self.n_frames):
+            draw_box(
+                self.iter_overlaid_frames(self.iter_heatmap_video_intensity()),
+                self.fps,
+                self.center_point,
+                self.window_size,
+                self.signal_ref,
+                os.path.join(self.output_dir, "heatmap.avi"),
+            )
 
 
 if __name__ == "__main__":
@@ -442,7 +836,105 @@ if __name__ == "__main__":
     )
     parser.add_argument("video_path", type=str, help="Path to the video file")
     parser.add_argument("mask_path", type=str, help="Path to the mask file")
+    parser.add_argument(
+        "--memmap-dir",
+        type=str,
+        default=None,
+        help="Decode the video once into memory-mapped .npy files in this directory",
+    )
+    parser.add_argument(
+        "--temporal-method",
+        choices=("fft", "tiled", "iir"),
+        default="fft",
+        help="Whole-video FFT band-pass, the same band-pass in float32 row bands "
+        "(low memory) or chunked IIR band-pass",
+    )
+    parser.add_argument(
+        "--no-zero-phase",
+        dest="zero_phase",
+        action="store_false",
+        help="Run the IIR band-pass forward only, which delays the patch signals by "
+        "its phase response (by default it runs forward and backward)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Worker processes for the patch stages, 0 for one per cpu",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=("cprofile", "sampling"),
+        default=None,
+        help="Dump a profile per stage into ./out/profiles",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="Record bytes allocated per stage with tracemalloc (slower)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Reuse filtered videos, signals and heart rate across runs "
+        "(e.g. ./cache/arrays)",
+    )
+    parser.add_argument(
+        "--patch-mode",
+        choices=("grid", "quadtree"),
+        default="grid",
+        help="Fixed 3x3 patches, or adaptive patches that stay coarse where the "
+        "SNR drops when split",
+    )
+    parser.add_argument(
+        "--max-patch-size",
+        type=int,
+        default=None,
+        help="Largest quadtree patch, 3 times a power of two (default 48)",
+    )
+    parser.add_argument(
+        "--method",
+        choices=RPPG_METHODS,
+        default="pos",
+        help="rPPG method for the heart rate and the patch signals",
+    )
+    parser.add_argument(
+        "--hr-tracking",
+        action="store_true",
+        help="Track the heart rate over time in sliding windows and let the "
+        "band-pass follow it (needs --temporal-method iir)",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Band-pass 3x3 patch means of the blurred frames instead of every "
+        "pixel, much faster and lighter with the same signals up to float rounding "
+        "(grid patches, always on for chrom and green)",
+    )
+    parser.add_argument(
+        "--jit",
+        action="store_true",
+        help="Run the per-patch loops (POS, SNR, time delays, heatmap fill) as "
+        "numba kernels if numba is installed",
+    )
     args = parser.parse_args()
 
-    pipe = Pipeline(args.video_path, args.mask_path)
+    pipe = Pipeline(
+        args.video_path,
+        args.mask_path,
+        memmap_dir=args.memmap_dir,
+        temporal_method=args.temporal_method,
+        zero_phase=args.zero_phase,
+        processes=args.processes,
+        profiler=args.profile,
+        trace_allocations=args.trace_allocations,
+        cache_dir=args.cache_dir,
+        patch_mode=args.patch_mode,
+        max_patch_size=args.max_patch_size,
+        method=args.method,
+        hr_tracking=args.hr_tracking,
+        fused=args.fused,
+        jit=args.jit,
+    )
     pipe.process_video_intensity()
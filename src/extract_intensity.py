@@ -4,7 +4,8 @@ import numpy as np
 
 from constants import gaussian_kernel
 from preproc import get_spatial_filtered_images, get_temporal_filtered_video
-from signals import get_pca_signal
+from signals import (get_pca_signal, get_tracked_patches,
+                     get_tracked_window_origins)
 from utils import load_video, select_center_point, select_segmenting_mask, write_video
 from visual import draw_signals
 
@@ -15,9 +16,6 @@ def main():
 
     n_frames, height, width, _ = video.shape
     features = np.load("../cache/features.npy")  # (n_frames, n_features, 2)
-    n_features = features.shape[1]
-
-    signals = []  # array of images rectangles for tracked features
 
     heatmaps = np.zeros((n_frames, height, width), dtype=np.float32)
 
@@ -25,42 +23,24 @@ def main():
     filtered_video = get_temporal_filtered_video(
         spatial_filtered_video, fps, (0.8, 1.5), alpha=2, attenuation=1
     )  # TODO: check alpha
-    for i in range(n_features):
-        for j in range(n_frames):
-            x, y = features[j, i, :]
-            x, y = int(x), int(y)
-            x_start, x_end = max(0, x - window_size // 2), min(
-                width, x + window_size // 2
-            )
-            y_start, y_end = max(0, y - window_size // 2), min(
-                height, y + window_size // 2
-            )
-            feature_patch = filtered_video[
-                :,
-                y_start:y_end,
-                x_start:x_end,
-                :,
-            ]
-        signal = get_pca_signal(feature_patch)
-        signals.append(signal)
+    # (n_features, T, window_size, window_size, 3), each window following its feature
+    feature_patches = get_tracked_patches(filtered_video, features, window_size)
+    signals = np.array([get_pca_signal(patch) for patch in feature_patches])
 
     plt.figure(figsize=(10, 6))
     signals_fingertip_palm = [signals[0], signals[2]]
     draw_signals(signals_fingertip_palm, "signals_fingertip_palm_id_0_2.png")
 
+    # paint the windows the signals were taken from
+    y_starts, x_starts = get_tracked_window_origins(
+        features, window_size, height, width
+    )
     for i in [0, 2]:
         for j in range(n_frames):
-            x, y = features[j, i]
-            x, y = int(x), int(y)
-            x_start, x_end = max(0, x - window_size // 2), min(
-                width, x + window_size // 2
-            )
-            y_start, y_end = max(0, y - window_size // 2), min(
-                height, y + window_size // 2
-            )
-            # print(heatmaps[j, y_start:y_end, x_start:x_end].shape)
-            # print(signals.shape)
-            heatmaps[j, y_start:y_end, x_start:x_end] = signal[j]
+            y_start, x_start = y_starts[j, i], x_starts[j, i]
+            heatmaps[
+                j, y_start : y_start + window_size, x_start : x_start + window_size
+            ] = signals[i][j]
 
     heatmaps = heatmaps / heatmaps.max()
     heatmaps_normalized = (heatmaps * 255).astype(np.uint8)
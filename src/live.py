@@ -0,0 +1,202 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+from scipy.signal import welch
+
+from signals import get_pos_signals
+from utils import select_center_point
+
+
+class LiveHeartRate:
+    """
+    sliding-window heart rate over a live frame source.
+
+    every frame adds one ROI mean to a ring buffer and extends the pulse signal by
+    overlap-adding POS over the last pos_seconds (constant work per frame). every
+    update_every frames the BPM is re-estimated with Welch over the last
+    window_seconds of pulse signal.
+    """
+
+    def __init__(
+        self,
+        fps,
+        center_point,
+        roi_radius=10,
+        window_seconds=10.0,
+        pos_seconds=1.6,
+        update_every=15,
+        freq_range=(0.7, 4.0),
+    ):
+        self.fps = fps
+        self.center_point = center_point
+        self.roi_radius = roi_radius
+        self.window_length = int(window_seconds * fps)
+        self.pos_length = max(int(pos_seconds * fps), 2)
+        self.update_every = update_every
+        self.freq_range = freq_range
+
+        # buffers are twice the window and compacted when full, so appends are O(1)
+        # amortized and the last window is always a contiguous slice
+        self.means = np.zeros((2 * self.window_length, 3), dtype=np.float32)
+        self.pulse = np.zeros(2 * self.window_length, dtype=np.float32)
+        self.head = 0
+        self.n_seen = 0
+
+        self.bpm = None
+        self.latencies = []
+
+    def _compact(self):
+        keep = self.window_length
+        self.means[:keep] = self.means[self.head - keep : self.head]
+        self.pulse[:keep] = self.pulse[self.head - keep : self.head]
+        self.pulse[keep:] = 0
+        self.head = keep
+
+    def update(self, frame, arrival_time=None):
+        """
+        feeds one rgb frame, returns the new BPM when it was re-estimated, else None
+        """
+        if arrival_time is None:
+            arrival_time = time.perf_counter()
+
+        y, x = self.center_point
+        r = self.roi_radius
+        roi = frame[max(y - r, 0) : y + r, max(x - r, 0) : x + r]
+
+        if self.head == len(self.means):
+            self._compact()
+        self.means[self.head] = roi.reshape(-1, 3).mean(axis=0)
+        self.head += 1
+        self.n_seen += 1
+
+        if self.head >= self.pos_length:
+            start = self.head - self.pos_length
+            h = get_pos_signals(self.means[start : self.head])
+            if np.all(np.isfinite(h)):
+                self.pulse[start : self.head] += h - h.mean()
+
+        if self.n_seen < self.window_length or self.n_seen % self.update_every:
+            return None
+
+        pulse = self.pulse[self.head - self.window_length : self.head]
+        freqs, psd = welch(pulse, fs=self.fps, nperseg=min(256, len(pulse)))
+        band = (freqs >= self.freq_range[0]) & (freqs <= self.freq_range[1])
+        self.bpm = freqs[band][np.argmax(psd[band])] * 60
+
+        self.latencies.append(time.perf_counter() - arrival_time)
+        return self.bpm
+
+
+def run_live(
+    source, center_point=None, realtime=False, show=False, **tracker_kwargs
+):
+    """
+    reads frames from a camera index or a stream/file url and prints BPM updates.
+    with realtime, frames are paced at the source fps, so a prerecorded file
+    behaves like a live stream.
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    print("Video fps:", fps)
+
+    tracker = None
+    start_time = time.perf_counter()
+    i = 0
+
+    while capture.isOpened():
+        if realtime:
+            delay = start_time + i / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        ret, frame = capture.read()
+        arrival_time = time.perf_counter()
+        if ret is False:
+            break
+        frame = frame[:, :, ::-1]
+
+        if tracker is None:
+            if center_point is None:
+                center_point = select_center_point(np.ascontiguousarray(frame))
+                if center_point is None:
+                    break
+            tracker = LiveHeartRate(fps, center_point, **tracker_kwargs)
+
+        bpm = tracker.update(frame, arrival_time)
+        if bpm is not None:
+            print(
+                f"t={i / fps:7.2f}s bpm={bpm:6.1f} "
+                f"latency={tracker.latencies[-1] * 1000:.2f}ms"
+            )
+
+        if show:
+            display = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2BGR)
+            if tracker.bpm is not None:
+                cv2.putText(
+                    display,
+                    f"BPM: {int(tracker.bpm)}",
+                    (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    1,
+                    (0, 255, 0),
+                    2,
+                    cv2.LINE_AA,
+                )
+            cv2.imshow("Live heart rate", display)
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+
+        i += 1
+
+    capture.release()
+    if show:
+        cv2.destroyAllWindows()
+
+    if tracker is not None and tracker.latencies:
+        latencies = np.array(tracker.latencies) * 1000
+        print(
+            f"{len(latencies)} updates, latency mean={latencies.mean():.2f}ms "
+            f"max={latencies.max():.2f}ms"
+        )
+    return tracker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Live heart rate from a camera or video stream."
+    )
+    parser.add_argument(
+        "source", type=str, help="Camera index (e.g. 0), stream url or video file"
+    )
+    parser.add_argument(
+        "--center",
+        type=int,
+        nargs=2,
+        metavar=("Y", "X"),
+        default=None,
+        help="ROI center, selected on the first frame if omitted",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Pace frames at the source fps (for prerecorded files)",
+    )
+    parser.add_argument(
+        "--update-every", type=int, default=15, help="Frames between BPM updates"
+    )
+    parser.add_argument(
+        "--window", type=float, default=10.0, help="Welch window in seconds"
+    )
+    parser.add_argument("--show", action="store_true", help="Display the frames")
+    args = parser.parse_args()
+
+    run_live(
+        args.source,
+        center_point=tuple(args.center) if args.center else None,
+        realtime=args.realtime,
+        show=args.show,
+        update_every=args.update_every,
+        window_seconds=args.window,
+    )
@@ -0,0 +1,121 @@
+from multiprocessing import Pool, cpu_count, shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+    """
+    numpy array backed by a named shared memory block.
+    pickles as (shape, dtype, name), so pool workers attach to the same buffer and
+    write their results in place instead of receiving and returning copies.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.owner = name is None
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        shared = cls(array.shape, array.dtype)
+        shared.array[:] = array
+        return shared
+
+    def __reduce__(self):
+        return (SharedArray, (self.array.shape, self.array.dtype.str, self.shm.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class MappedArray:
+    """
+    the file behind an np.memmap, reopened in each worker instead of pickling its data.
+    mode "r" for inputs (e.g. read-only cache entries), "r+" for outputs
+    """
+
+    def __init__(self, filename, shape, dtype, offset=0, mode="r"):
+        self.filename = filename
+        self.offset = offset
+        self.mode = mode
+        self.array = np.memmap(
+            filename, dtype=dtype, mode=mode, offset=offset, shape=shape
+        )
+
+    def __reduce__(self):
+        return (
+            MappedArray,
+            (
+                self.filename,
+                self.array.shape,
+                self.array.dtype.str,
+                self.offset,
+                self.mode,
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.mode != "r":
+            self.array.flush()
+
+
+def share(array):
+    """
+    wraps an array so it can be handed to run_row_bands without copying it per worker.
+    memmaps are reopened from their file, writable only if array is, anything else is
+    copied once to shared memory.
+    """
+    if isinstance(array, np.memmap) and array.filename is not None:
+        mode = "r+" if array.flags.writeable else "r"
+        return MappedArray(
+            array.filename, array.shape, array.dtype, array.offset, mode=mode
+        )
+    return SharedArray.from_array(array)
+
+
+def init_pool_processes(func_, shared_arrays_, kwargs_):
+    global func
+    global shared_arrays
+    global kwargs
+    func = func_
+    shared_arrays = shared_arrays_
+    kwargs = kwargs_
+
+
+def _run_band(bounds):
+    start, end = bounds
+    func(start, end, *(shared.array for shared in shared_arrays), **kwargs)
+
+
+def run_row_bands(func, n_rows, shared_arrays, processes=None, n_bands=None, **kwargs):
+    """
+    calls func(start, end, *arrays, **kwargs) for contiguous bands of rows on a
+    process pool. shared_arrays (SharedArray / MappedArray) and kwargs are sent once
+    per worker, after that only (start, end) index ranges cross the process boundary.
+    func must be picklable (module level or a staticmethod) and write its outputs
+    into the shared arrays.
+    """
+    processes = processes or cpu_count()
+    n_bands = min(n_bands or 4 * processes, n_rows)
+    bounds = np.linspace(0, n_rows, n_bands + 1).astype(int)
+    ranges = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    with Pool(
+        processes=processes,
+        initializer=init_pool_processes,
+        initargs=(func, shared_arrays, kwargs),
+    ) as pool:
+        pool.map(_run_band, ranges)
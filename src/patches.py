@@ -0,0 +1,193 @@
+import numpy as np
+
+from signals import get_patch_means, get_rppg_signals, get_snr_map
+
+
+def get_grid_patches(n_patches_h, n_patches_w, window_size):
+    """
+    (n_patches_h * n_patches_w, 4) rects (y, x, height, width) of the regular patch
+    grid in row-major order
+    """
+    i_indices, j_indices = np.meshgrid(
+        np.arange(n_patches_h), np.arange(n_patches_w), indexing="ij"
+    )
+    patches = np.empty((n_patches_h * n_patches_w, 4), dtype=np.int64)
+    patches[:, 0] = i_indices.flatten() * window_size
+    patches[:, 1] = j_indices.flatten() * window_size
+    patches[:, 2:] = window_size
+    return patches
+
+
+def get_rect_index_map(patches, height, width):
+    """
+    (height, width) map from every pixel to the index of the rect in patches
+    covering it, len(patches) where no rect does. rects must not overlap.
+    """
+    index_map = np.full((height, width), len(patches), dtype=np.intp)
+    for k, (y, x, h, w) in enumerate(patches):
+        index_map[y : y + h, x : x + w] = k
+    return index_map
+
+
+def _block_masks(mask, size):
+    """
+    per block of the size x size grid over mask (whose sides are multiples of size):
+    whether the mask is set on all / any of its pixels
+    """
+    height, width = mask.shape
+    blocks = mask.reshape(height // size, size, width // size, size)
+    return blocks.all(axis=(1, 3)), blocks.any(axis=(1, 3))
+
+
+def _level_means(
+    video, min_size, n_levels, method="pos", chunk_size=64, temporal_filter=None
+):
+    """
+    (T, n_h, n_w, n_stats) block means of every level, from min_size blocks up:
+    the finest in one get_patch_means pass over the video (then temporal_filter),
+    each coarser one as the mean of 2x2 blocks of the finer, which covers the same
+    pixels
+    """
+    means = get_patch_means(
+        video, min_size, chunk_size, chromaticity=method in ("chrom", "green")
+    )
+    if temporal_filter is not None:
+        means = temporal_filter(means)
+    level_means = [means]
+    for _ in range(n_levels - 1):
+        n_frames, n_h, n_w, n_stats = means.shape
+        means = (
+            means[:, : n_h // 2 * 2, : n_w // 2 * 2]
+            .reshape(n_frames, n_h // 2, 2, n_w // 2, 2, n_stats)
+            .mean(axis=(2, 4))
+        )
+        level_means.append(means)
+    return level_means
+
+
+def _block_signals(means, blocks, method="pos"):
+    """
+    rPPG signals (len(blocks), T) of the blocks at grid indices blocks of one level
+    of _level_means
+    """
+    block_means = means[:, blocks[:, 0], blocks[:, 1]].transpose(1, 0, 2)
+    return get_rppg_signals(block_means, [method])[method]
+
+
+def _children(blocks):
+    """
+    the four blocks of the next finer grid inside each of blocks, (4 * n, 2)
+    """
+    offsets = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
+    return (2 * blocks[:, np.newaxis] + offsets).reshape(-1, 2)
+
+
+def get_quadtree_patches(
+    video,
+    mask,
+    fs,
+    freq_range,
+    min_size,
+    max_size,
+    snr_threshold=None,
+    method="pos",
+    chunk_size=64,
+    temporal_filter=None,
+):
+    """
+    adaptive patches from a quadtree over the mask.
+
+    video is band-passed already, or temporal_filter(means) band-passes the
+    (T, n_h, n_w, n_stats) statistics of its min_size blocks. "chrom" and "green"
+    need the latter, see get_rppg_signals.
+
+    the frame is tiled with max_size blocks. blocks straddling the mask border are
+    split until they are inside the mask (at min_size, partial blocks are dropped
+    like in the regular grid). blocks inside the mask are split into their four
+    children only where every child's SNR (as in calc_valid_mask) stays at or above
+    snr_threshold, which defaults to the mean SNR of the largest blocks inside the
+    mask. averaging fewer pixels lowers the SNR of a weak pulse, so large skin areas
+    with a weak pulse stay coarse while areas with a strong pulse keep fine patches.
+
+    max_size must be min_size times a power of two.
+
+    Returns:
+        patches: (n, 4) int rects (y, x, height, width) in no particular order
+        signals: (n, T) float32 signals of the patches, from get_rppg_signals
+    """
+    n_levels = int(np.log2(max_size // min_size)) + 1
+    if min_size * 2 ** (n_levels - 1) != max_size:
+        raise ValueError("max_size must be min_size times a power of two")
+
+    # pad the mask to whole max_size blocks, the padding counts as outside
+    height, width = mask.shape
+    padded_mask = np.zeros(
+        (-(-height // max_size) * max_size, -(-width // max_size) * max_size),
+        dtype=bool,
+    )
+    padded_mask[:height, :width] = mask
+
+    # blocks inside the mask are inside the video, so their level means exist
+    level_means = _level_means(
+        video, min_size, n_levels, method, chunk_size, temporal_filter
+    )
+
+    size = max_size
+    inside, touching = _block_masks(padded_mask, size)
+    blocks = np.argwhere(touching)
+    signals = np.zeros((len(blocks), len(video)), dtype=np.float32)
+    is_inside = inside[blocks[:, 0], blocks[:, 1]]
+    signals[is_inside] = _block_signals(level_means[-1], blocks[is_inside], method)
+
+    leaf_patches = []
+    leaf_signals = []
+
+    for level in range(n_levels):
+        if level == n_levels - 1:
+            leaf_patches.append(
+                np.column_stack(
+                    (blocks[is_inside] * size, np.full((is_inside.sum(), 2), size))
+                )
+            )
+            leaf_signals.append(signals[is_inside])
+            break
+
+        if snr_threshold is None and is_inside.any():
+            # the typical SNR of the largest blocks inside the mask
+            snr, _ = get_snr_map(signals[is_inside], fs, freq_range)
+            snr_threshold = np.nanmean(snr)
+
+        child_size = size // 2
+        child_inside, child_touching = _block_masks(padded_mask, child_size)
+
+        children = _children(blocks)
+        child_is_inside = child_inside[children[:, 0], children[:, 1]]
+        child_signals = np.zeros((len(children), len(video)), dtype=np.float32)
+        child_signals[child_is_inside] = _block_signals(
+            level_means[n_levels - level - 2], children[child_is_inside], method
+        )
+
+        child_snr = np.full(len(children), np.nan)
+        child_snr[child_is_inside], _ = get_snr_map(
+            child_signals[child_is_inside], fs, freq_range
+        )
+        # nan (degenerate) children never pass, so their parent stays whole
+        split = np.zeros(len(blocks), dtype=bool)
+        if snr_threshold is not None:
+            split = (child_snr.reshape(-1, 4) >= snr_threshold).all(axis=1)
+        split = ~is_inside | split  # partial blocks always split
+
+        keep = is_inside & ~split
+        leaf_patches.append(
+            np.column_stack((blocks[keep] * size, np.full((keep.sum(), 2), size)))
+        )
+        leaf_signals.append(signals[keep])
+
+        next_blocks = np.repeat(split, 4)
+        next_blocks &= child_touching[children[:, 0], children[:, 1]]
+        blocks = children[next_blocks]
+        signals = child_signals[next_blocks]
+        is_inside = child_is_inside[next_blocks]
+        size = child_size
+
+    return np.concatenate(leaf_patches), np.concatenate(leaf_signals)
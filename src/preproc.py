@@ -1,6 +1,14 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import cv2
 import numpy as np
 import tqdm
+from scipy import fft as sp_fft
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+from signals import get_patch_means
 
 
 def pyrDown(image, kernel):
@@ -38,6 +46,212 @@ def temporal_bp_filter(images, fps, freq_range, axis=0):
     return np.fft.ifft(fft, axis=0).real
 
 
+def temporal_bp_filter_tiled(
+    images, fps, freq_range, out=None, max_band_bytes=256 * 2**20
+):
+    """
+    same result as temporal_bp_filter, computed one band of rows at a time with
+    single precision real FFTs and written into out, which can be images itself
+    (float32) to filter in place. peak memory is out plus about two bands.
+    """
+    n_frames = images.shape[0]
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+
+    frequencies = np.fft.fftfreq(n_frames, d=1.0 / fps)
+    low = (np.abs(frequencies - freq_range[0])).argmin()
+    high = (np.abs(frequencies - freq_range[1])).argmin()
+    keep = np.zeros(n_frames, dtype=np.float32)
+    keep[low:high] = 1
+
+    # temporal_bp_filter masks the two-sided spectrum and keeps the real part, which
+    # is the same as applying the mask averaged with its mirror image to the
+    # one-sided (real) spectrum
+    n_bins = n_frames // 2 + 1
+    mirrored = keep[(-np.arange(n_bins)) % n_frames]
+    gain = (0.5 * (keep[:n_bins] + mirrored)).reshape((-1,) + (1,) * (images.ndim - 1))
+
+    row_bytes = n_frames * int(np.prod(images.shape[2:])) * 4
+    band_rows = max(1, max_band_bytes // row_bytes)
+    for start in range(0, images.shape[1], band_rows):
+        band = np.asarray(images[:, start : start + band_rows], dtype=np.float32)
+        spectrum = sp_fft.rfft(band, axis=0)
+        spectrum *= gain
+        out[:, start : start + band_rows] = sp_fft.irfft(spectrum, n=n_frames, axis=0)
+
+    return out
+
+
+def design_bp_sos(fps, freq_range, order=4):
+    nyquist = 0.5 * fps
+    return butter(
+        order,
+        [freq_range[0] / nyquist, freq_range[1] / nyquist],
+        btype="band",
+        output="sos",
+    )
+
+
+def _iter_sos_filter(chunks, fps, freq_range, order, zi=None, start=0):
+    """
+    iter_temporal_bp_filter yielding the second-order-section state after each
+    chunk too. zi continues from an earlier state, start is the index of the first
+    frame in freq_range when it has a band per frame.
+    """
+    per_frame = freq_range.ndim == 2
+    sos = None if per_frame else design_bp_sos(fps, freq_range, order)
+
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if per_frame:
+            sos = design_bp_sos(fps, freq_range[start + len(chunk) // 2], order)
+        start += len(chunk)
+        if zi is None:
+            # start in steady state w.r.t. the first frame to avoid a step response
+            zi_shape = (sos.shape[0], 2) + (1,) * (chunk.ndim - 1)
+            zi = sosfilt_zi(sos).reshape(zi_shape) * chunk[0]
+        filtered, zi = sosfilt(sos, chunk, axis=0, zi=zi)
+        yield filtered.astype(np.float32), zi
+
+
+def iter_temporal_bp_filter(chunks, fps, freq_range, order=4):
+    """
+    causal butterworth band-pass over an iterable of (t, ...) frame chunks.
+    the second-order-section state is carried from one chunk to the next, so the
+    chunks can come straight from a decoder and only one is held in memory.
+
+    freq_range is one (low, high) band, or a (n_frames, 2) band per frame to follow
+    a changing heart rate. each chunk is then filtered with the band of its middle
+    frame, keeping the state across the redesigns, which stays smooth as long as
+    the band moves little from one chunk to the next.
+    """
+    freq_range = np.asarray(freq_range, dtype=np.float64)
+    for filtered, _ in _iter_sos_filter(chunks, fps, freq_range, order):
+        yield filtered
+
+
+def _settling_frames(fps, freq_range, order, n_frames, tolerance=1e-2):
+    """
+    frames until the impulse response of the narrowest band of freq_range stays
+    below tolerance of its peak, at most n_frames
+    """
+    bands = np.reshape(freq_range, (-1, 2))
+    band = bands[np.argmin(bands[:, 1] - bands[:, 0])]
+    impulse = np.zeros(n_frames)
+    impulse[0] = 1
+    response = np.abs(sosfilt(design_bp_sos(fps, band, order), impulse))
+    return int(np.nonzero(response >= tolerance * response.max())[0][-1]) + 1
+
+
+def _odd_extension(frames, pad, chunk_size):
+    """
+    chunks of 2 * frames[0] - frames[pad:0:-1], the reflection of the first frames
+    about the first one that filtfilt pads the start with
+    """
+    first = np.asarray(frames[0], dtype=np.float32)
+    for start in range(pad, 0, -chunk_size):
+        stop = max(start - chunk_size, 0)
+        yield 2 * first - np.asarray(frames[stop + 1 : start + 1][::-1], np.float32)
+
+
+def _odd_extension_end(tail, start, stop):
+    """
+    frames start:stop of 2 * tail[-1] - tail[-2::-1], the reflection of the last
+    frames about the last one that filtfilt pads the end with
+    """
+    n_tail = len(tail)
+    reflected = tail[n_tail - 1 - stop : n_tail - 1 - start][::-1]
+    return 2 * np.asarray(tail[-1], np.float32) - np.asarray(reflected, np.float32)
+
+
+def _filtfilt(frames, out, fps, freq_range, order, pad, chunk_size):
+    """
+    scipy's sosfiltfilt with padlen=pad in chunks of frames, into out (which may be
+    frames itself). the forward pass runs over frames with their odd extension at
+    both ends, the backward pass over its output from the end. the forward output
+    of the end extension is not kept, the backward pass recomputes each of its
+    chunks from the state saved before it.
+    """
+    n_frames = len(frames)
+    if freq_range.ndim == 2:
+        freq_range = np.concatenate(
+            (
+                np.repeat(freq_range[:1], pad, axis=0),
+                freq_range,
+                np.repeat(freq_range[-1:], pad, axis=0),
+            )
+        )
+    tail = frames[n_frames - 1 - pad :]
+    if np.may_share_memory(tail, out):
+        tail = np.array(tail, dtype=np.float32)  # the forward pass overwrites it
+
+    chunk_starts = range(0, n_frames, chunk_size)
+    chunks = itertools.chain(
+        _odd_extension(frames, pad, chunk_size),
+        (frames[start : start + chunk_size] for start in chunk_starts),
+    )
+    forward = _iter_sos_filter(chunks, fps, freq_range, order)
+    n_extension_chunks = len(range(pad, 0, -chunk_size))
+    for start, (chunk, zi) in zip(
+        chunk_starts, itertools.islice(forward, n_extension_chunks, None)
+    ):
+        out[start : start + chunk_size] = chunk
+
+    def filter_end(start, stop, zi):
+        chunk = _odd_extension_end(tail, start, stop)
+        band_start = pad + n_frames + start
+        return next(_iter_sos_filter([chunk], fps, freq_range, order, zi, band_start))
+
+    end_bounds = [
+        (start, min(start + chunk_size, pad)) for start in range(0, pad, chunk_size)
+    ]
+    end_states = []
+    for start, stop in end_bounds:
+        end_states.append(zi)
+        _, zi = filter_end(start, stop, zi)
+
+    def backward_chunks():
+        for (start, stop), zi in zip(end_bounds[::-1], end_states[::-1]):
+            yield filter_end(start, stop, zi)[0][::-1]
+        for start in chunk_starts:
+            yield out[::-1][start : start + chunk_size]
+
+    backward_range = freq_range[::-1] if freq_range.ndim == 2 else freq_range
+    backward = _iter_sos_filter(backward_chunks(), fps, backward_range, order)
+    for start, (chunk, _) in zip(
+        chunk_starts, itertools.islice(backward, len(end_bounds), None)
+    ):
+        out[::-1][start : start + chunk_size] = chunk
+
+
+def temporal_bp_filter_iir(
+    images, fps, freq_range, order=4, zero_phase=False, chunk_size=64, out=None
+):
+    """
+    chunked band-pass of a (T, ...) array into a float32 output, freq_range as in
+    iter_temporal_bp_filter. with zero_phase the output is filtered again backwards
+    like scipy's sosfiltfilt, which cancels the phase delay of the causal pass. the
+    frames are padded at both ends with an odd extension long enough for the filter
+    to settle, so that the ends of the clip keep their phase too.
+    """
+    n_frames = images.shape[0]
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+    freq_range = np.asarray(freq_range, dtype=np.float64)
+
+    if zero_phase:
+        pad = min(n_frames - 1, _settling_frames(fps, freq_range, order, n_frames))
+        _filtfilt(images, out, fps, freq_range, order, pad, chunk_size)
+        return out
+
+    chunk_starts = range(0, n_frames, chunk_size)
+    chunks = (images[start : start + chunk_size] for start in chunk_starts)
+    filtered = iter_temporal_bp_filter(chunks, fps, freq_range, order)
+    for start, chunk in zip(chunk_starts, filtered):
+        out[start : start + chunk_size] = chunk
+    return out
+
+
 def spatial_filter(image, kernel, level):
     """
     downsample + applies gaussian filter + upsample
@@ -61,28 +275,171 @@ def spatial_filter(image, kernel, level):
     return gaussian_pyramid
 
 
-def get_spatial_filtered_images(images, kernel, level):
-    filtered_images = np.zeros_like(images, dtype=np.float32)
-    # gaussian_pyramids = np.zeros(
-    #     (images.shape[0], images.shape[1], images.shape[2]), dtype=np.float32
-    # )
+_cv_depths = {
+    np.dtype(np.uint8): cv2.CV_8U,
+    np.dtype(np.float32): cv2.CV_32F,
+    np.dtype(np.float64): cv2.CV_64F,
+}
 
-    for i in tqdm.tqdm(
-        range(images.shape[0]),
-        ascii=True,
-        desc="Applying gaussian blur to spatially filter video",
-    ):
-        # green_channel = images[i, :, :, 1]
-        filtered_images[i] = spatial_filter(image=images[i], kernel=kernel, level=level)
+
+def separate_kernel(kernel):
+    """
+    splits a 2d kernel into its (column, row) 1d factors, None if it is not separable
+    """
+    column = kernel.sum(axis=1)
+    row = kernel.sum(axis=0) / kernel.sum()
+    if not np.allclose(np.outer(column, row), kernel):
+        return None
+    return column, row
+
+
+def _sep_filter(image, column, row):
+    # filter in floating point, then round half-to-even and saturate back to the
+    # input dtype, which is what filter2D does with ddepth=-1
+    ddepth = cv2.CV_64F if image.dtype == np.float64 else cv2.CV_32F
+    filtered = cv2.sepFilter2D(image, ddepth, row, column)
+    return filtered, _cv_depths[image.dtype]
+
+
+def fast_spatial_filter(image, kernel, level):
+    """
+    spatial_filter (bit-identical on uint8, within float rounding on float input),
+    but with two 1d passes instead of a 2d convolution per level, rounding only the decimated pixels on the way down and
+    upsampling by strided assignment into a zeroed buffer instead of np.insert
+    """
+    separable = separate_kernel(kernel)
+    if separable is None or image.dtype not in _cv_depths:
+        return spatial_filter(image, kernel, level)
+    column, row = separable
+
+    image_shape = [image.shape[:2]]
+    gaussian_pyramid = image
+
+    for _ in range(level):
+        filtered, depth = _sep_filter(gaussian_pyramid, column, row)
+        gaussian_pyramid = cv2.add(filtered[::2, ::2], 0.0, dtype=depth)
+        image_shape.append(gaussian_pyramid.shape[:2])
+
+    for curr_level in range(level):
+        dst_height, dst_width = image_shape[level - curr_level - 1]
+        upsampled_image = np.zeros(
+            (dst_height, dst_width) + gaussian_pyramid.shape[2:],
+            dtype=gaussian_pyramid.dtype,
+        )
+        upsampled_image[::2, ::2] = gaussian_pyramid
+        filtered, depth = _sep_filter(upsampled_image, 2 * column, 2 * row)
+        gaussian_pyramid = cv2.add(filtered, 0.0, dtype=depth)
+
+    return gaussian_pyramid
+
+
+def get_spatial_filtered_images(
+    images,
+    kernel,
+    level,
+    out=None,
+    n_threads=None,
+    batch_size=16,
+    window_size=None,
+    chromaticity=False,
+):
+    """
+    out: optional preallocated float32 array (e.g. an on-disk memmap) to write into
+    n_threads: frame batches are filtered on a thread pool (opencv releases the GIL),
+               defaults to the number of cpus
+    window_size: keep only the (T, H // window_size, W // window_size, c) patch
+                 means of every filtered frame, the same as get_patch_means of the
+                 full result without holding it
+    chromaticity: with window_size, append the means of the normalized rgb like
+                  get_patch_means
+    """
+    if window_size is None:
+        output_shape = images.shape
+    else:
+        output_shape = (
+            images.shape[0],
+            images.shape[1] // window_size,
+            images.shape[2] // window_size,
+            6 if chromaticity else images.shape[3],
+        )
+    if out is None:
+        filtered_images = np.empty(output_shape, dtype=np.float32)
+    else:
+        filtered_images = out
+
+    n_frames = images.shape[0]
+
+    def filter_batch(start):
+        end = min(start + batch_size, n_frames)
+        for i in range(start, end):
+            filtered_image = fast_spatial_filter(
+                image=np.asarray(images[i]), kernel=kernel, level=level
+            )
+            if window_size is not None:
+                filtered_image = get_patch_means(
+                    filtered_image[None], window_size, chromaticity=chromaticity
+                )[0]
+            filtered_images[i] = filtered_image
+        return end - start
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(filter_batch, start)
+            for start in range(0, n_frames, batch_size)
+        ]
+        with tqdm.tqdm(
+            total=n_frames,
+            ascii=True,
+            desc="Applying gaussian blur to spatially filter video",
+        ) as progress:
+            for future in as_completed(futures):
+                progress.update(future.result())
 
     return filtered_images
 
 
-def get_temporal_filtered_video(video, fps, freq_range, alpha, attenuation):
+def get_temporal_filtered_video(
+    video,
+    fps,
+    freq_range,
+    alpha,
+    attenuation,
+    method="fft",
+    zero_phase=False,
+    chunk_size=64,
+    out=None,
+):
+    """
+    method: "fft" filters the whole video at once in the frequency domain,
+    "tiled" gives the same result band by band in single precision (out may be
+    video itself), "iir" streams it through a chunked butterworth filter, which
+    also takes a (n_frames, 2) band per frame as freq_range
+    """
+    if np.ndim(freq_range) == 2 and method != "iir":
+        raise ValueError("A band per frame needs the iir temporal filter")
     print("got framerate ", fps)
-    filtered_images = temporal_bp_filter(
-        images=video, fps=fps, freq_range=freq_range
-    ).astype(np.float32)
+    if method == "fft":
+        filtered_images = temporal_bp_filter(
+            images=video, fps=fps, freq_range=freq_range
+        ).astype(np.float32)
+        if out is not None:
+            out[:] = filtered_images
+            filtered_images = out
+    elif method == "tiled":
+        filtered_images = temporal_bp_filter_tiled(
+            images=video, fps=fps, freq_range=freq_range, out=out
+        )
+    elif method == "iir":
+        filtered_images = temporal_bp_filter_iir(
+            images=video,
+            fps=fps,
+            freq_range=freq_range,
+            zero_phase=zero_phase,
+            chunk_size=chunk_size,
+            out=out,
+        )
+    else:
+        raise ValueError(f"Unknown temporal filter method: {method}")
     print("finished applying filters ", fps)
 
     filtered_images *= alpha
@@ -0,0 +1,175 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+def _max_rss_bytes(who):
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(who).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class SamplingProfiler:
+    """
+    samples the stack of one thread every interval seconds and counts the collapsed
+    stacks, which is the input format of flamegraph.pl / speedscope
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class StageRecorder:
+    """
+    records wall time, cpu time, peak rss, allocated bytes and items processed for
+    each named stage and writes them as a json run report.
+
+    trace_allocations: track numpy / python allocations with tracemalloc (slower)
+    profiler: None, "cprofile" (.prof per stage) or "sampling" (collapsed stacks
+              per stage), dumped into profile_dir
+    report_path: where the report is rewritten after every top-level stage
+    """
+
+    def __init__(
+        self,
+        trace_allocations=False,
+        profiler=None,
+        profile_dir="./out/profiles",
+        report_path=None,
+    ):
+        if profiler not in (None, "cprofile", "sampling"):
+            raise ValueError(f"Unknown profiler: {profiler}")
+        self.trace_allocations = trace_allocations
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.report_path = report_path
+        self.stages = []
+        self._active = []
+        # the allocation peak of each active stage before the last reset_peak
+        self._traced_peaks = []
+        self._start_time = time.time()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """
+        times the body of the with-block. the yielded dict can be updated inside it,
+        e.g. record["items"] = n once the number of processed items is known
+        """
+        full_name = "/".join(self._active + [name])
+        record = dict(name=full_name, items=items)
+        print(f"Calculating {full_name}")
+
+        if self.trace_allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # reset_peak wipes the peak of the enclosing stages too, keep it for them
+            _, traced_peak = tracemalloc.get_traced_memory()
+            self._traced_peaks = [max(p, traced_peak) for p in self._traced_peaks]
+            tracemalloc.reset_peak()
+            traced_start, _ = tracemalloc.get_traced_memory()
+            self._traced_peaks.append(traced_start)
+
+        # only profile the outermost stage, profilers do not nest
+        profiler = None
+        if self.profiler is not None and not self._active:
+            if self.profiler == "cprofile":
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                profiler = SamplingProfiler(threading.get_ident())
+                profiler.start()
+
+        self._active.append(name)
+        rss_start = _max_rss_bytes(resource.RUSAGE_SELF) if resource else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall_start
+            record["cpu"] = time.process_time() - cpu_start
+            self._active.pop()
+
+            if resource is not None:
+                record["peak_rss_bytes"] = _max_rss_bytes(resource.RUSAGE_SELF)
+                record["peak_rss_growth_bytes"] = record["peak_rss_bytes"] - rss_start
+                record["peak_rss_children_bytes"] = _max_rss_bytes(
+                    resource.RUSAGE_CHILDREN
+                )
+
+            if self.trace_allocations:
+                traced_end, traced_peak = tracemalloc.get_traced_memory()
+                traced_peak = max(traced_peak, self._traced_peaks.pop())
+                record["allocated_peak_bytes"] = traced_peak - traced_start
+                record["allocated_net_bytes"] = traced_end - traced_start
+
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                if self.profiler == "cprofile":
+                    profiler.disable()
+                    profile_path = os.path.join(self.profile_dir, f"{name}.prof")
+                    profiler.dump_stats(profile_path)
+                else:
+                    profiler.stop()
+                    profile_path = os.path.join(self.profile_dir, f"{name}.folded")
+                    profiler.dump(profile_path)
+                record["profile"] = profile_path
+
+            self.stages.append(record)
+            print(f"Finished {full_name} in {record['wall']:.2f}s")
+
+            if self.report_path is not None and not self._active:
+                self.save(self.report_path)
+
+    def report(self):
+        return dict(
+            started=self._start_time,
+            total_wall=sum(s["wall"] for s in self.stages if "/" not in s["name"]),
+            stages=self.stages,
+        )
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -98,8 +98,11 @@
 #     self.time_delays = delta_t
 
 
+from collections import deque
+
 import numpy as np
-from sklearn.decomposition import PCA
+from scipy.fft import next_fast_len
+from sklearn.decomposition import PCA, IncrementalPCA
 
 
 def get_chrom_signal(rgb_video):
@@ -148,14 +151,100 @@ def get_green_signal(rgb_video):
     return s
 
 
-def get_pca_signal(rgb_video):
-    reshaped_video = rgb_video.reshape(rgb_video.shape[0], -1).astype(np.float32)
-
-    pca = PCA(n_components=1)
-    principal_component = pca.fit_transform(reshaped_video)
-
-    s = principal_component.flatten()
-
+def get_pca_signal(
+    rgb_video, solver="full", chunk_size=64, pool=1, n_iter=2, seed=0
+):
+    """
+    first principal component over time of the pixels of a (T, H, W, 3) video.
+
+    solver "full" runs sklearn PCA on the whole (T, H*W*3) float32 matrix. the
+    streaming solvers only ever hold chunk_size frames of it:
+    "incremental": sklearn IncrementalPCA fed frame chunks, then one more pass to
+                   project them. memory grows with chunk_size and it is the
+                   slowest solver.
+    "randomized": a randomized range finder over frame chunks (Halko et al.), with
+                  n_iter power iterations. needs 3 + 2 * n_iter passes, but only
+                  (H*W*3, 11) float32 of state.
+    pool > 1 block-averages pool x pool pixels of each frame first, which cuts the
+    memory and time by pool**2 (and scales the signal accordingly).
+
+    the sign follows sklearn: the largest pixel weight of the component is positive.
+    """
+    if solver == "full" and pool == 1:
+        reshaped_video = rgb_video.reshape(rgb_video.shape[0], -1).astype(np.float32)
+
+        pca = PCA(n_components=1)
+        principal_component = pca.fit_transform(reshaped_video)
+
+        s = principal_component.flatten()
+
+        return s
+
+    def iter_chunks():
+        for start in range(0, len(rgb_video), chunk_size):
+            chunk = np.asarray(rgb_video[start : start + chunk_size], dtype=np.float32)
+            if pool > 1:
+                chunk = get_patch_means(chunk, pool)
+            yield start, chunk.reshape(len(chunk), -1)
+
+    if solver == "full":
+        reshaped_video = np.concatenate([chunk for _, chunk in iter_chunks()])
+        return PCA(n_components=1).fit_transform(reshaped_video).flatten()
+
+    n_frames = len(rgb_video)
+    s = np.empty(n_frames, dtype=np.float32)
+
+    if solver == "incremental":
+        # IncrementalPCA needs at least n_components frames per batch, and at
+        # most as many components as features
+        chunks = iter_chunks()
+        _, chunk = next(chunks)
+        n_components = min(
+            10, chunk.shape[1], chunk_size, n_frames % chunk_size or chunk_size
+        )
+        pca = IncrementalPCA(n_components=n_components)
+        pca.partial_fit(chunk)
+        for _, chunk in chunks:
+            pca.partial_fit(chunk)
+        for start, chunk in iter_chunks():
+            s[start : start + len(chunk)] = (chunk - pca.mean_) @ pca.components_[0]
+        return s
+
+    if solver != "randomized":
+        raise ValueError(f"Unknown PCA solver: {solver}")
+
+    mean = None
+    for _, chunk in iter_chunks():
+        chunk_sum = chunk.sum(axis=0, dtype=np.float64)
+        mean = chunk_sum if mean is None else mean + chunk_sum
+    mean = (mean / n_frames).astype(np.float32)
+
+    n_features = len(mean)
+    rng = np.random.default_rng(seed)
+    sketch = rng.standard_normal((n_features, 11)).astype(np.float32)
+
+    def project(right):  # (X - mean) @ right, (T, 11)
+        out = np.empty((n_frames, right.shape[1]), dtype=np.float32)
+        for start, chunk in iter_chunks():
+            out[start : start + len(chunk)] = (chunk - mean) @ right
+        return out
+
+    def project_transposed(left):  # (X - mean).T @ left, (n_features, 11)
+        out = np.zeros((n_features, left.shape[1]), dtype=np.float32)
+        for start, chunk in iter_chunks():
+            out += (chunk - mean).T @ left[start : start + len(chunk)]
+        return out
+
+    q, _ = np.linalg.qr(project(sketch))
+    for _ in range(n_iter):
+        z, _ = np.linalg.qr(project_transposed(q))
+        q, _ = np.linalg.qr(project(z))
+
+    b = project_transposed(q).T  # (11, n_features)
+    u_b, singular_values, vt = np.linalg.svd(b, full_matrices=False)
+    s = (q @ u_b[:, 0]) * singular_values[0]
+    if vt[0, np.argmax(np.abs(vt[0]))] < 0:
+        s = -s
     return s
 
 
@@ -173,22 +262,533 @@ def get_pos_signal(rgb_video):
     #    C[t] = [R_mean, G_mean, B_mean]
     C = rgb_video.mean(axis=(1, 2)).astype(np.float32)  # shape: (T, 3)
 
+    return get_pos_signals(C)
+
+
+def get_pos_signals(C):
+    """
+    POS projection for a batch of per-frame RGB means.
+
+    Args:
+        C: numpy array of shape (..., T, 3), spatially averaged RGB per time point,
+           e.g. (n_patches, T, 3).
+
+    Returns:
+        s: numpy array of shape (..., T), one raw POS pulse signal per leading index.
+    """
+    C = np.asarray(C, dtype=np.float32)
+
     # 2) Temporally normalize each channel (zero-mean, unit-variance)
-    mu = C.mean(axis=0)  # shape: (3,)
-    sigma = C.std(axis=0)  # shape: (3,)
-    Cn = (C - mu) / sigma  # shape: (T, 3)
+    mu = C.mean(axis=-2, keepdims=True)  # shape: (..., 1, 3)
+    sigma = C.std(axis=-2, keepdims=True)  # shape: (..., 1, 3)
+    Cn = (C - mu) / sigma  # shape: (..., T, 3)
 
     # 3) Project onto the POS subspace:
     #    P = [[ 0,  1, -1],
     #         [-2,  1,  1]]
     P = np.array([[0, 1, -1], [-2, 1, 1]], dtype=np.float32)  # shape: (2, 3)
 
-    #    S = Cn · Pᵀ  → shape (T, 2)
-    S = Cn.dot(P.T)
-    S1, S2 = S[:, 0], S[:, 1]
+    #    S = Cn · Pᵀ  → shape (..., T, 2)
+    S = Cn @ P.T
+    S1, S2 = S[..., 0], S[..., 1]
 
     # 4) Combine the two orthogonal components into a single 1-D signal
-    alpha = np.std(S1) / np.std(S2)
+    alpha = np.std(S1, axis=-1, keepdims=True) / np.std(S2, axis=-1, keepdims=True)
     s = S1 - alpha * S2
 
     return s
+
+
+def _chromaticity(pixels):
+    """
+    per-pixel normalized rgb, pixels / sqrt(r**2 + g**2 + b**2), as in
+    get_chrom_signal and get_green_signal
+    """
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    norm = np.sqrt(r**2 + g**2 + b**2)
+    return pixels / norm[..., np.newaxis]
+
+
+def _block_means_uint8(frames, window_size):
+    """
+    block means of uint8 (t, h, w, c) frames whose sides are multiples of
+    window_size. the rows and then the columns of every block are added as whole
+    slices in integers, which is exact and much faster than a mean over the strided
+    block axes.
+    """
+    n_frames, height, width, n_channels = frames.shape
+    n_patches_h = height // window_size
+    n_patches_w = width // window_size
+    accumulator = np.uint16 if window_size**2 * 255 < 2**16 else np.uint32
+
+    rows = frames.reshape(n_frames, n_patches_h, window_size, width * n_channels)
+    row_sums = rows[:, :, 0].astype(accumulator)
+    for k in range(1, window_size):
+        row_sums += rows[:, :, k]
+
+    columns = row_sums.reshape(
+        n_frames, n_patches_h, n_patches_w, window_size, n_channels
+    )
+    sums = columns[..., 0, :].astype(np.float32)
+    for k in range(1, window_size):
+        sums += columns[..., k, :]
+    return sums / window_size**2
+
+
+def get_patch_means(video, window_size, chunk_size=64, chromaticity=False):
+    """
+    block-reduces a (T, H, W, 3) video to per-patch RGB means of shape
+    (T, n_patches_h, n_patches_w, 3) in one reshape-and-mean pass per chunk of frames.
+
+    with chromaticity the means of the normalized rgb are appended in the same pass,
+    giving the (..., 6) statistics get_rppg_signals takes for every method.
+    """
+    n_frames, height, width, _ = video.shape
+    n_patches_h = height // window_size
+    n_patches_w = width // window_size
+    cropped_height = n_patches_h * window_size
+    cropped_width = n_patches_w * window_size
+    n_stats = 6 if chromaticity else 3
+
+    means = np.empty((n_frames, n_patches_h, n_patches_w, n_stats), dtype=np.float32)
+    for start in range(0, n_frames, chunk_size):
+        chunk = video[start : start + chunk_size, :cropped_height, :cropped_width]
+        if not chromaticity and chunk.dtype == np.uint8:
+            means[start : start + chunk_size] = _block_means_uint8(chunk, window_size)
+            continue
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if chromaticity:
+            chunk = np.concatenate((chunk, _chromaticity(chunk)), axis=-1)
+        means[start : start + chunk_size] = chunk.reshape(
+            len(chunk), n_patches_h, window_size, n_patches_w, window_size, n_stats
+        ).mean(axis=(2, 4))
+
+    return means
+
+
+def get_roi_stats(rgb_video):
+    """
+    (T, 6) per-frame RGB means and normalized rgb means of a (T, H, W, 3) ROI,
+    reduced exactly like get_pos_signal and get_chrom_signal
+    """
+    means = rgb_video.mean(axis=(1, 2)).astype(np.float32)
+    chromaticity_means = _chromaticity(rgb_video.astype(np.float32)).mean(axis=(1, 2))
+    return np.concatenate((means, chromaticity_means), axis=-1)
+
+
+RPPG_METHODS = ("pos", "chrom", "green", "rgb_pca")
+
+
+def get_rppg_signals(stats, methods=RPPG_METHODS):
+    """
+    pulse signals of several rPPG methods from one set of per-frame statistics.
+
+    Args:
+        stats: numpy array of shape (..., T, 6) from get_patch_means(...,
+               chromaticity=True) or get_roi_stats: RGB means followed by the means
+               of the normalized rgb. (..., T, 3) RGB means are enough for "pos"
+               and "rgb_pca". the normalized rgb needs the brightness of the
+               pixels, so for "chrom" and "green" take the statistics of frames
+               that are not band-passed and band-pass the statistics instead.
+        methods: any of "pos", "chrom" (as get_chrom_signal), "green" (as
+                 get_green_signal) and "rgb_pca" (get_pca_signal of the RGB means
+                 rather than of every pixel, with the same sign convention).
+
+    Returns:
+        dict of method -> numpy array of shape (..., T).
+    """
+    stats = np.asarray(stats, dtype=np.float32)
+    means = stats[..., :3]
+    signals = {}
+
+    for method in methods:
+        if method == "pos":
+            signals[method] = get_pos_signals(means)
+        elif method == "chrom":
+            r_n, g_n, b_n = stats[..., 3], stats[..., 4], stats[..., 5]
+            x_s = 3 * r_n - 2 * g_n
+            y_s = 1.5 * r_n + g_n - 1.5 * b_n
+            alpha = np.std(x_s, axis=-1, keepdims=True) / np.std(
+                y_s, axis=-1, keepdims=True
+            )
+            signals[method] = x_s - alpha * y_s
+        elif method == "green":
+            signals[method] = stats[..., 4]
+        elif method == "rgb_pca":
+            centered = means - means.mean(axis=-2, keepdims=True)
+            # right singular vectors of each (T, 3) block are its principal axes
+            _, _, vt = np.linalg.svd(centered, full_matrices=False)
+            component = vt[..., 0, :]
+            # like sklearn, the largest weight of the component is positive
+            largest = np.take_along_axis(
+                component, np.abs(component).argmax(axis=-1)[..., np.newaxis], axis=-1
+            )
+            component = component * np.where(largest < 0, -1, 1)
+            signals[method] = (centered @ component[..., np.newaxis])[..., 0]
+        else:
+            raise ValueError(f"Unknown rPPG method: {method}")
+
+    return signals
+
+
+def get_tracked_window_origins(features, window_size, height, width):
+    """
+    (y_start, x_start) int arrays of shape (T, n_features): the top left corner of
+    the window_size x window_size window of every tracked feature in every frame.
+    windows start at int(x) - window_size // 2 and are shifted, not cropped, to
+    stay inside the height x width frame.
+    """
+    x_start = np.clip(
+        features[..., 0].astype(int) - window_size // 2, 0, width - window_size
+    )
+    y_start = np.clip(
+        features[..., 1].astype(int) - window_size // 2, 0, height - window_size
+    )
+    return y_start, x_start
+
+
+def get_tracked_patches(video, features, window_size, chunk_size=64):
+    """
+    gathers the window_size x window_size window around every tracked feature in
+    every frame with one fancy-indexing pass per chunk of frames.
+
+    Args:
+        video: numpy array of shape (T, H, W, 3).
+        features: numpy array of shape (T, n_features, 2), (x, y) per frame as in
+                  cache/features.npy, placed as in get_tracked_window_origins.
+
+    Returns:
+        patches: float32 numpy array of shape (n_features, T, window_size,
+                 window_size, 3), ready for get_pca_signal per feature or, averaged
+                 over axes (2, 3), get_pos_signals for all features at once.
+    """
+    n_frames, height, width, _ = video.shape
+    n_features = features.shape[1]
+
+    y_start, x_start = get_tracked_window_origins(
+        features, window_size, height, width
+    )
+    offsets = np.arange(window_size)
+
+    patches = np.empty(
+        (n_features, n_frames, window_size, window_size, 3), dtype=np.float32
+    )
+    for start in range(0, n_frames, chunk_size):
+        chunk = np.asarray(video[start : start + chunk_size])
+        t = np.arange(len(chunk))[:, np.newaxis, np.newaxis, np.newaxis]
+        # (t, n_features, window_size, window_size) pixel indices
+        y = y_start[start : start + chunk_size, :, np.newaxis, np.newaxis]
+        x = x_start[start : start + chunk_size, :, np.newaxis, np.newaxis]
+        y = y + offsets[:, np.newaxis]
+        x = x + offsets
+        patches[:, start : start + chunk_size] = chunk[t, y, x].swapaxes(0, 1)
+
+    return patches
+
+
+def get_snr_map(signals, fs, freq_range, chunk_size=4096):
+    """
+    SNR in dB of every signal along the last axis, with one real FFT per chunk of
+    signals and the band masks built once. Signal power is the power inside
+    freq_range, noise power the power in the remaining non-negative frequencies.
+
+    Returns:
+        snr: numpy array of shape signals.shape[:-1], NaN where either power is 0.
+        n_degenerate: number of signals whose signal or noise power is 0.
+    """
+    n = signals.shape[-1]
+    flat_signals = signals.reshape(-1, n)
+
+    freqs = np.fft.rfftfreq(n, d=1 / fs)
+    if n % 2 == 0:
+        # np.fft.fftfreq labels the nyquist bin as negative, so leave it out as well
+        freqs = freqs[:-1]
+    signal_mask = (freqs >= freq_range[0]) & (freqs <= freq_range[1])
+    noise_mask = ~signal_mask
+
+    signal_power = np.empty(len(flat_signals))
+    noise_power = np.empty(len(flat_signals))
+    for start in range(0, len(flat_signals), chunk_size):
+        chunk = np.asarray(flat_signals[start : start + chunk_size], dtype=np.float64)
+        spectrum = np.fft.rfft(chunk, axis=-1)
+        power_spectrum = np.abs(spectrum[:, : len(freqs)]) ** 2 / n
+        signal_power[start : start + chunk_size] = power_spectrum @ signal_mask
+        noise_power[start : start + chunk_size] = power_spectrum @ noise_mask
+
+    degenerate = (signal_power == 0) | (noise_power == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        snr = 10 * np.log10(signal_power / noise_power)
+    snr[degenerate] = np.nan
+
+    return snr.reshape(signals.shape[:-1]), int(degenerate.sum())
+
+
+def get_time_delays(
+    signals,
+    signal_ref,
+    fps,
+    max_lag_frames,
+    method="fft",
+    interpolate=True,
+    chunk_size=4096,
+):
+    """
+    Time delay of every signal relative to signal_ref, taken at the peak of their
+    (mean-removed) cross-correlation over lags |lag| <= max_lag_frames.
+
+    Args:
+        signals: numpy array of shape (..., T).
+        signal_ref: numpy array of shape (T,).
+        method: "fft" correlates in the frequency domain, "direct" only evaluates
+                the 2 * max_lag_frames + 1 lags that are searched.
+        interpolate: refine the peak to a sub-frame lag with a parabola through
+                     the peak and its two neighbours.
+
+    Returns:
+        delays: numpy array of shape signals.shape[:-1], in seconds.
+    """
+    n = signals.shape[-1]
+    flat_signals = signals.reshape(-1, n)
+    delays = np.empty(len(flat_signals))
+
+    if max_lag_frames < 0:
+        delays[:] = np.nan
+        return delays.reshape(signals.shape[:-1])
+
+    max_lag = min(max_lag_frames, n - 1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    signal_ref_centered = signal_ref - np.mean(signal_ref)
+
+    if method == "fft":
+        # padding to n + max_lag keeps the searched lags free of circular wrap-around
+        n_fft = next_fast_len(n + max_lag)
+        ref_spectrum = np.conj(np.fft.rfft(signal_ref_centered, n_fft))
+    elif method != "direct":
+        raise ValueError(f"Unknown time delay method: {method}")
+
+    for start in range(0, len(flat_signals), chunk_size):
+        chunk = np.asarray(flat_signals[start : start + chunk_size], dtype=np.float64)
+        chunk = chunk - chunk.mean(axis=-1, keepdims=True)
+
+        if method == "fft":
+            correlation = np.fft.irfft(np.fft.rfft(chunk, n_fft) * ref_spectrum, n_fft)
+            correlation = correlation[:, lags]  # negative lags wrap to the end
+        else:
+            correlation = np.empty((len(chunk), len(lags)))
+            for k, lag in enumerate(lags):
+                if lag >= 0:
+                    correlation[:, k] = chunk[:, lag:] @ signal_ref_centered[: n - lag]
+                else:
+                    correlation[:, k] = chunk[:, : n + lag] @ signal_ref_centered[-lag:]
+
+        peak = np.argmax(correlation, axis=-1)
+        chunk_delays = lags[peak].astype(np.float64)
+
+        if interpolate and len(lags) > 2:
+            inner = (peak > 0) & (peak < len(lags) - 1)
+            rows = np.nonzero(inner)[0]
+            y0 = correlation[rows, peak[rows] - 1]
+            y1 = correlation[rows, peak[rows]]
+            y2 = correlation[rows, peak[rows] + 1]
+            curvature = y0 - 2 * y1 + y2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                offset = np.where(curvature != 0, 0.5 * (y0 - y2) / curvature, 0.0)
+            chunk_delays[rows] += offset
+
+        delays[start : start + chunk_size] = chunk_delays / fps
+
+    return delays.reshape(signals.shape[:-1])
+
+
+def get_sliding_spectrum(signal, fs, window_size, hop, freqs):
+    """
+    hann-windowed power of signal at freqs (Hz) in windows of window_size samples,
+    one every hop samples. window_size must be a multiple of hop.
+
+    every hop-long block is transformed once (at freqs and at freqs +- fs /
+    window_size, which give the hann window in the frequency domain) and the
+    spectrum of a window is the difference of two running sums of the block
+    spectra, so overlapping windows share their transforms and the cost does not
+    grow with the overlap.
+
+    Returns:
+        power: (n_windows, len(freqs)) float64, window k starts at sample k * hop
+    """
+    if window_size % hop:
+        raise ValueError("window_size must be a multiple of hop")
+    signal = np.asarray(signal, dtype=np.float64)
+    n_blocks = len(signal) // hop
+    blocks_per_window = window_size // hop
+    if window_size == 0 or n_blocks < blocks_per_window:
+        raise ValueError("signal is shorter than one window")
+    n_windows = n_blocks - blocks_per_window + 1
+
+    shift = fs / window_size
+    freqs = np.asarray(freqs, dtype=np.float64)
+    omega = 2 * np.pi * np.concatenate((freqs - shift, freqs, freqs + shift)) / fs
+
+    # block spectra with their phase referenced to sample 0
+    blocks = signal[: n_blocks * hop].reshape(n_blocks, hop)
+    block_spectra = blocks @ np.exp(-1j * np.outer(np.arange(hop), omega))
+    block_spectra *= np.exp(-1j * np.outer(np.arange(n_blocks) * hop, omega))
+    running = np.zeros((n_blocks + 1, len(omega)), dtype=complex)
+    np.cumsum(block_spectra, axis=0, out=running[1:])
+
+    spectra = running[blocks_per_window:] - running[:n_windows]
+    # back to phases referenced to the window start, the hann terms need them
+    spectra *= np.exp(1j * np.outer(np.arange(n_windows) * hop, omega))
+    lower, center, upper = np.split(spectra, 3, axis=1)
+    return np.abs(0.5 * center - 0.25 * (lower + upper)) ** 2
+
+
+def track_spectral_peak(power, max_jump=None):
+    """
+    bin of the peak in every row of power (n_windows, n_bins). with max_jump the
+    peak moves at most max_jump bins between consecutive windows, along the path
+    with the highest summed log power (viterbi), so a few windows dominated by
+    noise do not pull the track away. None takes every window's argmax.
+    """
+    if max_jump is None:
+        return np.argmax(power, axis=1)
+
+    n_windows, n_bins = power.shape
+    log_power = np.log(
+        power / power.sum(axis=1, keepdims=True) + np.finfo(np.float64).tiny
+    )
+    bins = np.arange(n_bins)
+    back = np.zeros((n_windows, n_bins), dtype=np.intp)
+    score = log_power[0]
+    for k in range(1, n_windows):
+        # the best predecessor within max_jump bins of every bin
+        padded = np.pad(score, max_jump, constant_values=-np.inf)
+        candidates = np.lib.stride_tricks.sliding_window_view(
+            padded, 2 * max_jump + 1
+        )
+        best = np.argmax(candidates, axis=1)
+        back[k] = bins + best - max_jump
+        score = candidates[bins, best] + log_power[k]
+
+    path = np.empty(n_windows, dtype=np.intp)
+    path[-1] = np.argmax(score)
+    for k in range(n_windows - 1, 0, -1):
+        path[k - 1] = back[k, path[k]]
+    return path
+
+
+def get_heart_rate_track(
+    signal,
+    fs,
+    window_seconds=10.0,
+    hop_seconds=1.0,
+    freq_range=(0.7, 4.0),
+    bpm_step=0.5,
+    max_bpm_change=5.0,
+):
+    """
+    heart rate over time from the spectral peak of overlapping windows of a pulse
+    signal (get_sliding_spectrum), refined by parabolic interpolation of the log
+    power. a window longer than the signal is shrunk to it.
+
+    max_bpm_change: fastest change followed, in BPM per second, None to take the
+                    strongest peak of every window on its own
+
+    Returns:
+        times: (n_windows,) window centres in seconds
+        bpm: (n_windows,) heart rate of each window
+    """
+    hop = max(1, int(round(hop_seconds * fs)))
+    window_size = min(int(round(window_seconds * fs)), len(signal)) // hop * hop
+    step = bpm_step / 60
+    freqs = np.arange(freq_range[0], freq_range[1] + step / 2, step)
+
+    power = get_sliding_spectrum(signal, fs, window_size, hop, freqs)
+    max_jump = None
+    if max_bpm_change is not None:
+        max_jump = max(1, int(np.ceil(max_bpm_change * hop / fs / bpm_step)))
+    peaks = track_spectral_peak(power, max_jump)
+
+    offsets = np.zeros(len(peaks))
+    rows = np.nonzero((peaks > 0) & (peaks < len(freqs) - 1))[0]
+    log_power = np.log(power + np.finfo(np.float64).tiny)
+    left, center, right = (log_power[rows, peaks[rows] + d] for d in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    is_peak = curvature < 0
+    offsets[rows[is_peak]] = 0.5 * (left - right)[is_peak] / curvature[is_peak]
+
+    times = (np.arange(len(power)) * hop + window_size / 2) / fs
+    return times, (freqs[peaks] + offsets * step) * 60
+
+
+class PeakRateTracker:
+    """
+    streaming heart rate from the peaks of a pulse signal fed one sample at a time.
+
+    a sample is a peak once the next lower sample confirms it (plateaus peak at
+    their middle). peaks closer than min_distance samples to the previous one only
+    replace it when higher. the rate is the mean RR interval of the peaks in the
+    last window samples, from the first and last peak, so each update is O(1)
+    amortized.
+
+    on a clean pulse this is the BPM of find_peaks(distance=min_distance) on the
+    last window samples. on a noisy one they differ: find_peaks keeps the highest
+    peaks of the window first, so a noise peak min_distance away from two beats
+    stays, while the tracker only compares each peak with the last one it kept.
+    they differ most when the period is close to 2 * min_distance (60 BPM by
+    default), where find_peaks counts those noise peaks and the tracker is the
+    closer to the true rate (see test_peak_rate.py).
+    """
+
+    def __init__(self, fps, window_seconds=3.0, min_distance=None):
+        self.fps = fps
+        self.window = int(window_seconds * fps)
+        self.min_distance = fps / 2 if min_distance is None else min_distance
+        self.peaks = deque()  # (index, height, peak it displaced)
+        self.n_seen = 0
+        self._previous = None
+        self._rise_start = None  # first index of a rising edge or plateau
+
+    def update(self, x):
+        """
+        feeds one sample, returns the current BPM (0 with fewer than two peaks)
+        """
+        k = self.n_seen
+        previous = self._previous
+        if previous is not None:
+            if x > previous:
+                self._rise_start = k
+            elif x < previous and self._rise_start is not None:
+                self._add_peak((self._rise_start + k - 1) // 2, previous)
+                self._rise_start = None
+        self._previous = x
+        self.n_seen += 1
+
+        # a peak on the first sample of the window has no left neighbour in it
+        while self.peaks and self.peaks[0][0] <= self.n_seen - self.window:
+            self.peaks.popleft()
+        return self.bpm
+
+    def _add_peak(self, index, height):
+        displaced = None
+        if self.peaks and index - self.peaks[-1][0] < self.min_distance:
+            if height <= self.peaks[-1][1]:
+                return
+            displaced = self.peaks.pop()
+            # a peak the popped one had displaced comes back once it is far enough
+            # from its neighbours, like find_peaks which drops lower peaks first
+            restored = displaced[2]
+            if (
+                restored is not None
+                and index - restored[0] >= self.min_distance
+                and (not self.peaks or restored[0] - self.peaks[-1][0] >= self.min_distance)
+            ):
+                self.peaks.append(restored)
+        self.peaks.append((index, height, displaced))
+
+    @property
+    def bpm(self):
+        if len(self.peaks) < 2:
+            return 0
+        avg_rr_interval = (self.peaks[-1][0] / self.fps - self.peaks[0][0] / self.fps) / (
+            len(self.peaks) - 1
+        )
+        return 60 / avg_rr_interval
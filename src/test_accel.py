@@ -0,0 +1,296 @@
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import accel
+import extract
+import signals
+import visual
+from patches import get_grid_patches, get_rect_index_map
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def get_snr(signal, fs, freq_range):
+    """
+    the per-signal SNR that extract.Pipeline computed before get_snr_map
+    """
+    N = len(signal)
+    freq_domain = np.fft.fft(signal)
+    freqs = np.fft.fftfreq(N, d=1 / fs)
+
+    pos_mask = freqs >= 0
+    freqs = freqs[pos_mask]
+    freq_domain = freq_domain[pos_mask]
+
+    power_spectrum = np.abs(freq_domain) ** 2 / N
+
+    signal_mask = (freqs >= freq_range[0]) & (freqs <= freq_range[1])
+    signal_power = np.sum(power_spectrum[signal_mask])
+    noise_power = np.sum(power_spectrum[~signal_mask])
+
+    if noise_power == 0 or signal_power == 0:
+        return np.nan
+    return 10 * np.log10(signal_power / noise_power)
+
+
+def make_stats(rng, n_patches, n_frames, fps):
+    """
+    (n_patches, n_frames, 6) statistics of skin-like patches with a pulse of a
+    random phase and noise, plus a flat patch whose POS signal is nan
+    """
+    t = np.arange(n_frames) / fps
+    phase = rng.uniform(0, 2 * np.pi, (n_patches, 1))
+    pulse = np.sin(2 * np.pi * 1.2 * t + phase)
+    means = np.array([120, 100, 90]) + rng.normal(0, 1, (n_patches, n_frames, 3))
+    means += pulse[..., np.newaxis] * np.array([-0.5, 1.0, 0.5])
+    means[0] = means[0, 0]
+    stats = np.concatenate((means, signals._chromaticity(means)), axis=-1)
+    return stats.astype(np.float32)
+
+
+def check_rppg(stats):
+    with np.errstate(invalid="ignore"):  # the flat patch
+        expected = signals.get_rppg_signals(stats)
+        result = accel.get_rppg_signals(stats)
+        _, numpy_time = timed(signals.get_rppg_signals, stats, ["pos"])
+        _, accel_time = timed(accel.get_rppg_signals, stats, ["pos"])
+    for method in signals.RPPG_METHODS:
+        # the kernel works in float64, numpy in float32
+        np.testing.assert_allclose(
+            result[method], expected[method], rtol=1e-3, atol=1e-3, equal_nan=True
+        )
+    # the serial kernel runs the same loop body per patch
+    np.testing.assert_array_equal(
+        accel.get_rppg_signals(stats, ["pos"], parallel=False)["pos"], result["pos"]
+    )
+    print(f"rppg signals ok, pos: numpy {numpy_time:.3f}s, accel {accel_time:.3f}s")
+
+
+def check_snr(pos, fps):
+    pos = np.nan_to_num(pos)  # the flat patch is degenerate
+    for n_frames in (pos.shape[1], pos.shape[1] - 1):  # even and odd lengths
+        band = (1.05, 1.35)
+        (expected, expected_degenerate), numpy_time = timed(
+            signals.get_snr_map, pos[:, :n_frames], fps, band
+        )
+        (result, degenerate), accel_time = timed(
+            accel.get_snr_map, pos[:, :n_frames], fps, band
+        )
+        np.testing.assert_allclose(result, expected, atol=1e-6, equal_nan=True)
+        assert degenerate == expected_degenerate
+    print(f"snr map ok: numpy {numpy_time:.3f}s, accel {accel_time:.3f}s")
+
+    for signal in pos[1:4]:
+        np.testing.assert_allclose(
+            accel.get_snr_map(signal[np.newaxis], fps, band)[0][0],
+            get_snr(signal, fps, band),
+            atol=1e-6,
+        )
+    print("snr map matches the per-signal snr")
+
+
+def check_time_delays(pos, fps):
+    pos = pos[1:]
+    signal_ref = pos[:9].mean(axis=0)
+    max_lag_frames = int(0.34 * fps)
+    for interpolate in (True, False):
+        for method in ("fft", "direct"):
+            expected, numpy_time = timed(
+                signals.get_time_delays,
+                pos,
+                signal_ref,
+                fps,
+                max_lag_frames,
+                method=method,
+                interpolate=interpolate,
+            )
+            result, accel_time = timed(
+                accel.get_time_delays,
+                pos,
+                signal_ref,
+                fps,
+                max_lag_frames,
+                interpolate=interpolate,
+            )
+            # flat correlation peaks amplify rounding in the interpolation
+            np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-7)
+            print(
+                f"time delays ok against {method}, interpolate={interpolate}: "
+                f"numpy {numpy_time:.3f}s, accel {accel_time:.3f}s"
+            )
+
+
+def check_heatmap(rng, n_frames=10):
+    height, width, window_size = 720, 1280, 3
+    mask = np.zeros((height // window_size, width // window_size), dtype=bool)
+    mask[20:200, 50:400] = True
+    patches = get_grid_patches(*mask.shape, window_size)[mask.flatten()]
+    index_map = get_rect_index_map(patches, height, width)
+
+    values = rng.integers(0, 256, (n_frames, len(patches)), dtype=np.uint8)
+    lut = visual.get_colormap_lut()
+    expected, numpy_time = timed(
+        lambda: list(visual.iter_heatmap_frames(values, index_map, lut))
+    )
+    result, accel_time = timed(
+        lambda: list(accel.iter_heatmap_frames(values, index_map, lut))
+    )
+    for result_frame, expected_frame in zip(result, expected):
+        np.testing.assert_array_equal(result_frame, expected_frame)
+    print(f"heatmap frames ok: numpy {numpy_time:.3f}s, accel {accel_time:.3f}s")
+
+
+def check_signals_map_band(rng, fps):
+    """
+    Pipeline._signals_map_band with and without jit on a small filtered video
+    """
+    n_frames, window_size = 150, 3
+    n_patches_h, n_patches_w = 20, 30
+    t = np.arange(n_frames) / fps
+    video = rng.normal(
+        0, 1, (n_frames, n_patches_h * window_size, n_patches_w * window_size, 3)
+    ).astype(np.float32)
+    video += np.sin(2 * np.pi * 1.2 * t)[:, None, None, None]
+    mask = rng.random((n_patches_h, n_patches_w)) > 0.3
+    row_offsets = np.concatenate(([0], np.cumsum(mask.sum(axis=1))))
+
+    s_lists = []
+    for jit in (False, True):
+        s_list = np.zeros((row_offsets[-1], n_frames), dtype=np.float32)
+        extract.Pipeline._signals_map_band(
+            0,
+            n_patches_h,
+            video,
+            s_list,
+            patch_segmentation_mask=mask,
+            window_size=window_size,
+            row_offsets=row_offsets,
+            method="pos",
+            jit=jit,
+        )
+        s_lists.append(s_list)
+    np.testing.assert_allclose(s_lists[1], s_lists[0], rtol=1e-3, atol=1e-3)
+    print("Pipeline._signals_map_band ok")
+
+
+# runs one kernel in a fresh process, which loads it from the numba cache, and
+# prints the threading layer numba launched, if any
+CACHED_RUN = """
+import numba
+import numpy as np
+
+import accel
+
+signals = np.random.default_rng(0).random((64, 100))
+accel.get_time_delays(signals, signals[0], 30.0, 5, parallel={parallel})
+try:
+    print(numba.threading_layer())
+except ValueError:  # no parallel region was run
+    print("none")
+"""
+
+
+def check_cached_serial():
+    """
+    the serial and threaded kernels have separate cache entries, so a process
+    that only asks for the serial one never starts numba's thread pool, even
+    when the threaded one was cached first
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+        layers = []
+        for parallel in (True, False, False):
+            run = subprocess.run(
+                [sys.executable, "-c", CACHED_RUN.format(parallel=parallel)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            layers.append(run.stdout.split()[-1])
+    assert layers[0] != "none", layers
+    assert layers[1:] == ["none", "none"], layers
+    print(f"cached kernels ok, threading layer {layers[0]} only when parallel")
+
+
+def check_fallback(stats, fps):
+    """
+    accel without numba returns the numpy results
+    """
+    with np.errstate(invalid="ignore"):  # the flat patch
+        expected = signals.get_rppg_signals(stats)
+    pos = np.nan_to_num(expected["pos"])
+    signal_ref = pos[1:10].mean(axis=0)
+
+    numba = sys.modules.get("numba")
+    sys.modules["numba"] = None  # makes `import numba` raise ImportError
+    try:
+        fallback = importlib.reload(accel)
+        assert not fallback.HAVE_NUMBA
+        with np.errstate(invalid="ignore"):
+            result = fallback.get_rppg_signals(stats)
+        for method in signals.RPPG_METHODS:
+            np.testing.assert_array_equal(result[method], expected[method])
+        np.testing.assert_array_equal(
+            fallback.get_snr_map(pos, fps, (1.05, 1.35))[0],
+            signals.get_snr_map(pos, fps, (1.05, 1.35))[0],
+        )
+        np.testing.assert_array_equal(
+            fallback.get_time_delays(pos, signal_ref, fps, 10),
+            signals.get_time_delays(pos, signal_ref, fps, 10),
+        )
+    finally:
+        if numba is None:
+            del sys.modules["numba"]
+        else:
+            sys.modules["numba"] = numba
+        importlib.reload(accel)
+    print("numpy fallback ok")
+
+
+def main():
+    if accel.HAVE_NUMBA:
+        print("numba found, compiling the kernels")
+    else:
+        print("numba is not installed, checking the numpy fallback")
+
+    rng = np.random.default_rng(0)
+    fps = 30.0
+
+    # compile outside the timings
+    warm_stats = make_stats(rng, 4, 32, fps)[1:]
+    accel.get_rppg_signals(warm_stats, ["pos"])
+    accel.get_snr_map(warm_stats[..., 0], fps, (1, 2))
+    accel.get_time_delays(warm_stats[..., 0], warm_stats[0, :, 0], fps, 3)
+    warm_frames = accel.iter_heatmap_frames(
+        [np.zeros(1, np.uint8)], np.zeros((2, 2), np.intp), visual.get_colormap_lut()
+    )
+    list(warm_frames)
+
+    stats = make_stats(rng, 20000, 300, fps)
+    check_rppg(stats)
+    with np.errstate(invalid="ignore"):
+        pos = signals.get_rppg_signals(stats, ["pos"])["pos"]
+    check_snr(pos, fps)
+    check_time_delays(pos, fps)
+    check_heatmap(rng)
+    check_signals_map_band(rng, fps)
+    check_fallback(stats[:2000], fps)
+    if accel.HAVE_NUMBA:
+        check_cached_serial()
+    print("all kernels match")
+
+
+if __name__ == "__main__":
+    main()
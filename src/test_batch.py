@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import batch
+
+
+class RecordingPipeline:
+    """
+    stands in for Pipeline in process_entry, counting the entries it runs
+    """
+
+    runs = []
+
+    def __init__(self, video_path, mask_path, center_point, output_dir, **kwargs):
+        self.runs.append((video_path, kwargs))
+        self.heart_rate = 70.0
+        self.fps = 30.0
+        self.n_frames = 300
+        self.valid_mask = np.ones((4, 4), dtype=bool)
+
+    def process_video_intensity(self):
+        pass
+
+
+def check_rerun(output_root):
+    """
+    a finished entry is skipped only when its entry and pipeline_kwargs both match
+    """
+    entry = dict(name="face", video="face.mp4", mask="face.npy", center=[10, 20])
+    pipeline_kwargs = dict(method="pos", temporal_method="fft", zero_phase=True)
+
+    assert batch.process_entry(entry, output_root, pipeline_kwargs)["status"] == "done"
+    assert batch.process_entry(entry, output_root, pipeline_kwargs)["status"] == "skipped"
+    assert len(RecordingPipeline.runs) == 1
+
+    with open(os.path.join(output_root, "face", "result.json")) as f:
+        stored = json.load(f)
+    assert stored["pipeline_kwargs"] == pipeline_kwargs, stored
+    assert stored["center"] == entry["center"], stored
+
+    changed_kwargs = dict(pipeline_kwargs, method="green")
+    result = batch.process_entry(entry, output_root, changed_kwargs)
+    assert result["status"] == "done", result
+    assert RecordingPipeline.runs[-1][1]["method"] == "green"
+    print("changed pipeline kwargs rerun ok")
+
+    # another video written into the same output directory
+    other_entry = dict(entry, video="other.mp4")
+    result = batch.process_entry(other_entry, output_root, changed_kwargs)
+    assert result["status"] == "done" and result["video"] == "other.mp4", result
+    other_center = dict(other_entry, center=[11, 20])
+    assert batch.process_entry(other_center, output_root, changed_kwargs)["status"] == "done"
+    assert len(RecordingPipeline.runs) == 4
+    print("changed entry rerun ok")
+
+
+def main():
+    batch.Pipeline = RecordingPipeline
+    with tempfile.TemporaryDirectory() as output_root:
+        check_rerun(output_root)
+    print("batch restarts match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import numpy as np
+
+import extract
+from constants import gaussian_kernel
+from profiling import StageRecorder
+
+
+def make_pipeline(rng, method, temporal_method, n_frames=150, fps=30.0):
+    """
+    a Pipeline with only what calc_signals_map needs set, on a uint8 video with a
+    pulse whose phase drifts across the frame
+    """
+    height, width, window_size = 60, 84, 3
+    t = np.arange(n_frames)[:, None, None] / fps
+    x = np.arange(width)[None, None, :] / width
+    pulse = 4 * np.sin(2 * np.pi * 1.2 * (t - 0.1 * x))
+    noise = rng.normal(0, 2, (n_frames, height, width, 3))
+    video = np.stack((120 - 0.5 * pulse, 100 + pulse, 90 + 0.5 * pulse), axis=-1)
+    video = np.clip(video + noise, 0, 255).astype(np.uint8)
+
+    pipeline = object.__new__(extract.Pipeline)
+    pipeline.recorder = StageRecorder()
+    pipeline.video = video
+    pipeline.fps = fps
+    pipeline.n_frames = n_frames
+    pipeline.kernel = gaussian_kernel
+    pipeline.pyramid_level = 3
+    pipeline.alpha = 2
+    pipeline.window_size = window_size
+    pipeline.n_patches_h = height // window_size
+    pipeline.n_patches_w = width // window_size
+    pipeline.patch_segmentation_mask = (
+        rng.random((pipeline.n_patches_h, pipeline.n_patches_w)) > 0.2
+    )
+    pipeline.temporal_method = temporal_method
+    pipeline.zero_phase = True
+    pipeline.method = method
+    pipeline.processes = 1
+    pipeline.jit = False
+    pipeline.cache = None
+    pipeline.memmap_dir = None
+    return pipeline
+
+
+def check_fused(rng, method, temporal_method):
+    """
+    the fused signals are the signals of the full filtered video
+    """
+    pipeline = make_pipeline(rng, method, temporal_method)
+    filter_range = (1.05, 1.35)
+    expected = pipeline._compute_signals_map(filter_range)
+    result = pipeline._compute_fused_signals_map(filter_range)
+
+    error = np.linalg.norm(result - expected) / np.linalg.norm(expected)
+    correlations = [np.corrcoef(a, b)[0, 1] for a, b in zip(result, expected)]
+    assert error < 1e-4, error
+    assert min(correlations) > 1 - 1e-6, min(correlations)
+    print(
+        f"fused {method} with {temporal_method} ok: relative error {error:.1e}, "
+        f"min correlation {min(correlations):.8f}"
+    )
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for method in ("pos", "rgb_pca"):
+        for temporal_method in ("fft", "tiled", "iir"):
+            check_fused(rng, method, temporal_method)
+    print("fused signals match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.signal import find_peaks
+
+from signals import PeakRateTracker
+
+
+def windowed_bpm(s, fps, window_seconds=3.0):
+    """
+    the BPM iter_boxed_frames drew before PeakRateTracker: find_peaks on the
+    samples of the last window, recomputed for every sample
+    """
+    window = int(window_seconds * fps)
+    bpm = np.zeros(len(s))
+    for i in range(1, len(s) + 1):
+        peaks, _ = find_peaks(s[max(0, i - window) : i], distance=fps / 2)
+        if len(peaks) > 1:
+            bpm[i - 1] = 60 / np.mean(np.diff(peaks / fps))
+    return bpm
+
+
+def tracked_bpm(s, fps, window_seconds=3.0):
+    tracker = PeakRateTracker(fps, window_seconds=window_seconds)
+    return np.array([tracker.update(x) for x in s])
+
+
+def make_pulse(rng, rate, noise, n_frames=900, fps=30.0):
+    t = np.arange(n_frames) / fps
+    return np.sin(2 * np.pi * rate / 60 * t) + rng.normal(0, noise, n_frames)
+
+
+def check_clean(fps=30.0):
+    """
+    on a clean pulse the tracker reads the same BPM as windowed find_peaks
+    """
+    rng = np.random.default_rng(0)
+    for rate in (48, 60, 72, 90, 120, 150):
+        s = make_pulse(rng, rate, noise=0)
+        np.testing.assert_allclose(tracked_bpm(s, fps), windowed_bpm(s, fps), atol=1e-9)
+    print("clean pulses ok: same BPM as windowed find_peaks")
+
+
+def check_noisy(fps=30.0, noise=0.2):
+    """
+    on a noisy pulse the two pick different peaks. the tracker stays at least as
+    close to the true rate, and away from a period of twice the peak distance
+    (60 BPM at the default) the two mostly agree
+    """
+    for seed in range(3):
+        rng = np.random.default_rng(seed)
+        for rate in (60, 72, 120):
+            s = make_pulse(rng, rate, noise)
+            # after the first window, once both have a full window of peaks
+            tracked = tracked_bpm(s, fps)[int(3 * fps) :]
+            windowed = windowed_bpm(s, fps)[int(3 * fps) :]
+
+            tracked_error = np.mean(np.abs(tracked - rate))
+            windowed_error = np.mean(np.abs(windowed - rate))
+            assert tracked_error <= windowed_error + 1.5, (rate, seed)
+
+            difference = np.abs(tracked - windowed)
+            if rate != 60:
+                assert np.median(difference) < 1, (rate, seed)
+                assert np.percentile(difference, 90) < 15, (rate, seed)
+            print(
+                f"{rate} BPM with noise {noise} ok: error {tracked_error:.1f} BPM "
+                f"(find_peaks {windowed_error:.1f}), differs by "
+                f"{np.median(difference):.1f} BPM median"
+            )
+
+
+def main():
+    check_clean()
+    check_noisy()
+    print("peak rates match")
+
+
+if __name__ == "__main__":
+    main()
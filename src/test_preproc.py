@@ -0,0 +1,106 @@
+import numpy as np
+from scipy.signal import sosfiltfilt
+
+import preproc
+from constants import gaussian_kernel
+
+
+def make_frames(rng, n_frames, shape=(5,), fps=30.0):
+    """
+    float32 (T, ...) frames of a pulse on a bright background with noise
+    """
+    t = np.arange(n_frames).reshape((-1,) + (1,) * len(shape)) / fps
+    frames = 100 + np.sin(2 * np.pi * 1.2 * t) + rng.normal(0, 0.3, (n_frames,) + shape)
+    return frames.astype(np.float32)
+
+
+def check_zero_phase(rng, fps=30.0, freq_range=(1.05, 1.35)):
+    """
+    the zero-phase iir band-pass against scipy's sosfiltfilt with the same padding,
+    in chunks that do not divide the frames, in place and with a band per frame
+    """
+    sos = preproc.design_bp_sos(fps, freq_range)
+    for n_frames in (100, 1000):
+        frames = make_frames(rng, n_frames)
+        pad = min(
+            n_frames - 1, preproc._settling_frames(fps, freq_range, 4, n_frames)
+        )
+        expected = sosfiltfilt(sos, frames.astype(np.float64), axis=0, padlen=pad)
+        atol = 1e-5 * np.abs(expected).max()
+
+        for chunk_size in (7, 64, n_frames):
+            result = preproc.temporal_bp_filter_iir(
+                frames, fps, freq_range, zero_phase=True, chunk_size=chunk_size
+            )
+            np.testing.assert_allclose(result, expected, rtol=0, atol=atol)
+
+        in_place = frames.copy()
+        preproc.temporal_bp_filter_iir(
+            in_place, fps, freq_range, zero_phase=True, out=in_place
+        )
+        np.testing.assert_allclose(in_place, expected, rtol=0, atol=atol)
+
+        per_frame = np.tile(freq_range, (n_frames, 1))
+        result = preproc.temporal_bp_filter_iir(
+            frames, fps, per_frame, zero_phase=True
+        )
+        np.testing.assert_allclose(result, expected, rtol=0, atol=atol)
+        print(f"zero-phase iir of {n_frames} frames ok (padded by {pad})")
+
+
+def check_fast_spatial_filter(rng, level=3):
+    """
+    fast_spatial_filter against spatial_filter on even and odd frame sizes:
+    bit-identical on uint8, within float32 rounding on float input
+    """
+    for shape in ((60, 84, 3), (61, 85, 3), (37, 53, 3), (33, 47)):
+        image = rng.integers(0, 256, shape, dtype=np.uint8)
+        expected = preproc.spatial_filter(image, gaussian_kernel, level)
+        result = preproc.fast_spatial_filter(image, gaussian_kernel, level)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+        image = rng.uniform(0, 255, shape).astype(np.float32)
+        expected = preproc.spatial_filter(image, gaussian_kernel, level)
+        result = preproc.fast_spatial_filter(image, gaussian_kernel, level)
+        assert result.dtype == expected.dtype
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6 * 255)
+        print(f"fast spatial filter of {shape} frames ok")
+
+
+def check_tiled(rng, fps=30.0, freq_range=(1.05, 1.35)):
+    """
+    temporal_bp_filter_tiled against the FFT of the whole video, for odd and even
+    frame counts, bands of rows that do not divide the frame height and in place
+    """
+    for n_frames in (150, 151):
+        frames = make_frames(rng, n_frames, shape=(10, 7, 3))
+        expected = preproc.temporal_bp_filter(frames, fps, freq_range)
+        atol = 1e-5 * np.abs(expected).max()
+
+        # 3 rows per band, the last band has 1
+        row_bytes = n_frames * 7 * 3 * 4
+        for max_band_bytes in (3 * row_bytes, 256 * 2**20):
+            result = preproc.temporal_bp_filter_tiled(
+                frames, fps, freq_range, max_band_bytes=max_band_bytes
+            )
+            np.testing.assert_allclose(result, expected, rtol=0, atol=atol)
+
+            in_place = frames.copy()
+            preproc.temporal_bp_filter_tiled(
+                in_place, fps, freq_range, out=in_place, max_band_bytes=max_band_bytes
+            )
+            np.testing.assert_allclose(in_place, expected, rtol=0, atol=atol)
+        print(f"tiled band-pass of {n_frames} frames ok")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    check_zero_phase(rng)
+    check_fast_spatial_filter(rng)
+    check_tiled(rng)
+    print("preproc filters match")
+
+
+if __name__ == "__main__":
+    main()
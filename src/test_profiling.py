@@ -0,0 +1,51 @@
+import numpy as np
+
+from profiling import StageRecorder
+
+MB = 1024 * 1024
+
+
+def check_nested_peak():
+    """
+    a nested stage does not hide what the enclosing stage allocated before it
+    """
+    recorder = StageRecorder(trace_allocations=True)
+    with recorder.stage("outer"):
+        buffer = np.ones(50 * MB, dtype=np.uint8)
+        del buffer
+        with recorder.stage("inner"):
+            small = np.ones(MB, dtype=np.uint8)
+            del small
+        with recorder.stage("second_inner"):
+            pass
+
+    peaks = {s["name"]: s["allocated_peak_bytes"] for s in recorder.stages}
+    assert peaks["outer"] >= 50 * MB, peaks
+    assert MB <= peaks["outer/inner"] < 2 * MB, peaks
+    assert peaks["outer/second_inner"] < MB, peaks
+    print(f"nested stage peaks ok: {peaks}")
+
+
+def check_inner_peak():
+    """
+    the enclosing stage includes the peak of its nested stages
+    """
+    recorder = StageRecorder(trace_allocations=True)
+    with recorder.stage("outer"):
+        with recorder.stage("inner"):
+            buffer = np.ones(20 * MB, dtype=np.uint8)
+            del buffer
+
+    peaks = {s["name"]: s["allocated_peak_bytes"] for s in recorder.stages}
+    assert peaks["outer"] >= peaks["outer/inner"] >= 20 * MB, peaks
+    print(f"enclosing stage peak ok: {peaks}")
+
+
+def main():
+    check_nested_peak()
+    check_inner_peak()
+    print("stage allocations match")
+
+
+if __name__ == "__main__":
+    main()
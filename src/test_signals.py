@@ -0,0 +1,114 @@
+import numpy as np
+
+import signals
+
+
+def make_video(rng, n_frames=300, height=12, width=15, fps=30.0, amplitude=3):
+    """
+    uint8 (T, H, W, 3) skin-like video with a pulse and noise
+    """
+    t = np.arange(n_frames)[:, None, None, None] / fps
+    pulse = amplitude * np.sin(2 * np.pi * 1.2 * t) * np.array([-0.5, 1.0, 0.5])
+    noise = rng.normal(0, 4, (n_frames, height, width, 3))
+    video = np.array([150, 110, 90]) + pulse + noise
+    return np.clip(video, 0, 255).astype(np.uint8)
+
+
+STANDALONE = {
+    "pos": signals.get_pos_signal,
+    "chrom": signals.get_chrom_signal,
+    "green": signals.get_green_signal,
+    # rgb_pca is get_pca_signal of the RGB means, as a 1x1 video
+    "rgb_pca": lambda video: signals.get_pca_signal(
+        video.mean(axis=(1, 2), dtype=np.float32)[:, None, None]
+    ),
+}
+
+# relative to the signal amplitude. sklearn fits the float32 (T, 3) means of
+# get_pca_signal through their covariance, which is off by up to 2e-3 of it on
+# noisy patches (get_rppg_signals stays within 1e-5 of a float64 fit)
+TOLERANCE = {"pos": 1e-5, "chrom": 1e-5, "green": 1e-5, "rgb_pca": 5e-3}
+
+
+def check_roi(video):
+    """
+    every method of get_rppg_signals on get_roi_stats against its standalone
+    function on the ROI pixels
+    """
+    rppg_signals = signals.get_rppg_signals(signals.get_roi_stats(video))
+    for method in signals.RPPG_METHODS:
+        expected = STANDALONE[method](video)
+        np.testing.assert_allclose(
+            rppg_signals[method],
+            expected,
+            rtol=0,
+            atol=TOLERANCE[method] * np.abs(expected).max(),
+        )
+        print(f"{method} of the roi statistics ok")
+
+
+def check_patches(video, window_size=3):
+    """
+    every method of get_rppg_signals on get_patch_means against its standalone
+    function on the pixels of each patch
+    """
+    stats = signals.get_patch_means(video, window_size, chromaticity=True)
+    rppg_signals = signals.get_rppg_signals(stats.transpose(1, 2, 0, 3))
+    for method in signals.RPPG_METHODS:
+        for i in range(stats.shape[1]):
+            for j in range(stats.shape[2]):
+                patch = video[
+                    :,
+                    i * window_size : (i + 1) * window_size,
+                    j * window_size : (j + 1) * window_size,
+                ]
+                expected = STANDALONE[method](patch)
+                np.testing.assert_allclose(
+                    rppg_signals[method][i, j],
+                    expected,
+                    rtol=0,
+                    atol=TOLERANCE[method] * np.abs(expected).max(),
+                )
+        print(f"{method} of {stats.shape[1] * stats.shape[2]} patch statistics ok")
+
+
+def check_pca_solvers(rng):
+    """
+    the streaming and pooled solvers of get_pca_signal against the full PCA, down to
+    a 1x1 ROI with fewer features (3) than the incremental solver's 10 components
+    """
+    for height, width in ((1, 1), (2, 2), (12, 15)):
+        video = make_video(rng, height=height, width=width, amplitude=6)
+        expected = signals.get_pca_signal(video)
+        for solver in ("incremental", "randomized"):
+            np.testing.assert_allclose(
+                signals.get_pca_signal(video, solver=solver),
+                expected,
+                rtol=0,
+                atol=5e-3 * np.abs(expected).max(),
+            )
+        print(f"pca solvers of {height}x{width} pixels ok")
+
+    video = make_video(rng, height=12, width=16, amplitude=6)
+    expected = signals.get_pca_signal(signals.get_patch_means(video, 4))
+    for solver in ("full", "incremental", "randomized"):
+        np.testing.assert_allclose(
+            signals.get_pca_signal(video, solver=solver, pool=4),
+            expected,
+            rtol=0,
+            atol=5e-3 * np.abs(expected).max(),
+        )
+    print("pooled pca solvers ok")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    video = make_video(rng)
+    check_roi(video)
+    check_patches(video)
+    check_pca_solvers(rng)
+    print("all methods match their standalone functions")
+
+
+if __name__ == "__main__":
+    main()
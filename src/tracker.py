@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import os
+import time
+
+import cv2
+import numpy as np
+
+from utils import iter_video_chunks
+
+
+def detect_features(
+    frame, mask=None, max_features=25, quality_level=0.01, min_distance=10
+):
+    """
+    (n, 2) float32 (x, y) corners of an rgb frame to track, inside mask if given
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    if mask is not None:
+        mask = mask.astype(np.uint8)
+    corners = cv2.goodFeaturesToTrack(
+        gray, max_features, quality_level, min_distance, mask=mask
+    )
+    if corners is None:
+        return np.empty((0, 2), dtype=np.float32)
+    return corners.reshape(-1, 2)
+
+
+def track_features(frames, points, win_size=(21, 21), max_level=3, fb_threshold=1.0):
+    """
+    follows points (n, 2) float32 (x, y) through an iterable of rgb frames with
+    pyramidal Lucas-Kanade, all points in one call per frame. each frame is
+    converted to gray once and reused as the previous image of the next step (the
+    python bindings do not take prebuilt pyramids).
+
+    a track is lost when LK fails, it leaves the frame, or tracking it back to the
+    previous frame misses its start by more than fb_threshold pixels (None skips
+    this check, which halves the work). lost tracks keep their last position and
+    are not tracked any further.
+
+    Returns:
+        features: (n_frames, n, 2) float32 positions, the format of
+                  cache/features.npy
+        tracked: (n_frames, n) bool, False from the frame a track was lost
+    """
+    points = np.array(points, dtype=np.float32).reshape(-1, 2)
+    lk_kwargs = dict(
+        winSize=win_size,
+        maxLevel=max_level,
+        criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+    )
+
+    features = []
+    tracked = []
+    active = np.ones(len(points), dtype=bool)
+    prev_gray = None
+
+    for frame in frames:
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+        if prev_gray is not None and active.any():
+            prev_points = points[active]
+            next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                prev_gray, gray, prev_points, None, **lk_kwargs
+            )
+            height, width = gray.shape
+            ok = (
+                (status.ravel() == 1)
+                & (next_points[:, 0] >= 0)
+                & (next_points[:, 0] <= width - 1)
+                & (next_points[:, 1] >= 0)
+                & (next_points[:, 1] <= height - 1)
+            )
+            if fb_threshold is not None:
+                back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+                    gray, prev_gray, next_points, None, **lk_kwargs
+                )
+                fb_error = np.linalg.norm(back_points - prev_points, axis=1)
+                ok &= (back_status.ravel() == 1) & (fb_error <= fb_threshold)
+
+            active_indices = np.nonzero(active)[0]
+            points[active_indices[ok]] = next_points[ok]
+            active[active_indices[~ok]] = False
+
+        features.append(points.copy())
+        tracked.append(active.copy())
+        prev_gray = gray
+
+    return np.array(features), np.array(tracked)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Track features through a video with sparse optical flow."
+    )
+    parser.add_argument("video_path", type=str, help="Path to the video file")
+    parser.add_argument(
+        "--mask",
+        type=str,
+        default=None,
+        help="Segmentation mask .npy, features are only detected inside it",
+    )
+    parser.add_argument("--max-features", type=int, default=25)
+    parser.add_argument(
+        "--fb-threshold",
+        type=float,
+        default=1.0,
+        help="Forward-backward error in pixels at which a track is lost, "
+        "negative to skip the backward check",
+    )
+    parser.add_argument("--output", type=str, default="./cache/features.npy")
+    args = parser.parse_args()
+
+    chunks = iter_video_chunks(args.video_path)
+    first_chunk = next(chunks)
+    mask = np.load(args.mask).astype(bool) if args.mask else None
+    points = detect_features(first_chunk[0], mask, max_features=args.max_features)
+    print(f"Tracking {len(points)} features")
+
+    start = time.perf_counter()
+    features, tracked = track_features(
+        (frame for chunk in itertools.chain([first_chunk], chunks) for frame in chunk),
+        points,
+        fb_threshold=args.fb_threshold if args.fb_threshold >= 0 else None,
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"Tracked {len(features)} frames in {elapsed:.2f}s "
+        f"({len(features) / elapsed:.1f} fps), {int(tracked[-1].sum())} tracks left"
+    )
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    np.save(args.output, features)
+    np.save(os.path.splitext(args.output)[0] + "_tracked.npy", tracked)
+    print(f"Features saved as {args.output}")
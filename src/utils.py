@@ -1,5 +1,11 @@
+import json
+import os
+import queue
+import threading
+
 import cv2
 import numpy as np
+import tqdm
 
 
 def load_video(video_path):
@@ -20,17 +26,223 @@ def load_video(video_path):
     return np.asarray(image_sequence), fps
 
 
+def get_video_info(video_path):
+    """
+    returns (n_frames, height, width, fps) as reported by the container, without decoding
+    """
+    video = cv2.VideoCapture(video_path)
+    n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return n_frames, height, width, fps
+
+
+def iter_video_chunks(video_path, chunk_size=64):
+    """
+    lazily decodes a video and yields rgb chunks of shape (<=chunk_size, H, W, 3),
+    so only one chunk of frames is held in memory at a time
+    """
+    video = cv2.VideoCapture(video_path)
+    chunk = []
+
+    while video.isOpened():
+        ret, frame = video.read()
+
+        if ret is False:
+            break
+
+        chunk.append(frame[:, :, ::-1])
+        if len(chunk) == chunk_size:
+            yield np.asarray(chunk)
+            chunk = []
+
+    video.release()
+    if chunk:
+        yield np.asarray(chunk)
+
+
+def _video_source(video_path):
+    """
+    what a decoded memmap is checked against before it is reused
+    """
+    stat = os.stat(video_path)
+    return {
+        "path": os.path.abspath(video_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _write_npy_header(f, shape):
+    # npy headers are padded so the first axis can grow without changing their size
+    np.lib.format.write_array_header_1_0(
+        f,
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+            "fortran_order": False,
+            "shape": tuple(shape),
+        },
+    )
+
+
+def _load_decoded_video(memmap_path, info_path, source):
+    """
+    the memmap decoded from source, or None if it is missing, incomplete or was
+    decoded from another (or a since modified) video
+    """
+    if not (os.path.exists(memmap_path) and os.path.exists(info_path)):
+        return None
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+        video = np.load(memmap_path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        print(f"Decoding {memmap_path} again, could not read it: {e}")
+        return None
+    if (
+        info.get("source") != source
+        or info.get("shape") != list(video.shape)
+        or video.dtype != np.uint8
+    ):
+        print(f"Decoding {memmap_path} again, it is from another video")
+        return None
+    return video
+
+
+def load_video_memmap(video_path, memmap_path, chunk_size=64):
+    """
+    decodes a video once into an on-disk .npy file and returns it memory-mapped
+    (read-only), so later stages can slice frames without holding the clip in RAM.
+
+    the file is written under a temporary name and renamed when complete, next to a
+    memmap_path + ".json" with the shape and the path, size and mtime of the video.
+    an existing memmap_path is only reused when they still match.
+    """
+    n_frames, _, _, fps = get_video_info(video_path)
+    info_path = memmap_path + ".json"
+    source = _video_source(video_path)
+
+    video = _load_decoded_video(memmap_path, info_path, source)
+    if video is not None:
+        print("Video fps:", fps)
+        return video, fps
+
+    if os.path.exists(info_path):
+        os.remove(info_path)
+    tmp_path = memmap_path + ".tmp"
+    shape = None
+    try:
+        with open(tmp_path, "wb") as f:
+            # the container frame count is only an estimate (0 when unknown), so
+            # the frames are appended as they are decoded and counted in the header
+            for chunk in tqdm.tqdm(
+                iter_video_chunks(video_path, chunk_size),
+                total=-(-n_frames // chunk_size) if n_frames > 0 else None,
+                ascii=True,
+                desc="Decoding video to memmap",
+            ):
+                if shape is None:
+                    shape = [0, *chunk.shape[1:]]
+                    _write_npy_header(f, shape)
+                    offset = f.tell()
+                f.write(chunk.tobytes())
+                shape[0] += len(chunk)
+
+            if shape is None:
+                raise ValueError(f"Could not decode any frame of {video_path}")
+            f.seek(0)
+            _write_npy_header(f, shape)
+            if f.tell() != offset:
+                raise ValueError(
+                    f"The npy header of {tmp_path} changed size with {shape[0]} frames"
+                )
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, memmap_path)
+
+    with open(info_path, "w") as f:
+        json.dump({"source": source, "shape": shape}, f, indent=2)
+
+    print("Video fps:", fps)
+    return np.load(memmap_path, mmap_mode="r"), fps
+
+
+class BackgroundVideoWriter:
+    """
+    encodes rgb frames with cv2.VideoWriter on a background thread. frames are
+    handed over through a queue of at most max_queue frames, so rendering and
+    encoding overlap while memory stays bounded. the file is opened with the size
+    of the first frame written. frames must not be modified after write().
+    """
+
+    def __init__(self, output_name, fps, fourcc="MJPG", max_queue=8):
+        self.output_name = output_name
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.n_frames = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        video_writer = None
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._error is not None:
+                continue  # keep draining so write() never blocks on a dead writer
+            try:
+                if video_writer is None:
+                    height, width = frame.shape[:2]
+                    video_writer = cv2.VideoWriter(
+                        self.output_name, self.fourcc, self.fps, (width, height)
+                    )
+                video_writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+            except Exception as e:
+                self._error = e
+        if video_writer is not None:
+            video_writer.release()
+
+    def write(self, frame):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(frame)
+        self.n_frames += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # an error from the producer is the one to raise, the writer's is reported
+        try:
+            self.close()
+        except Exception as e:
+            print(f"Video writer also failed on {self.output_name}: {e!r}")
+
+
 def write_video(video, fps, output_name):
     """
-    takes an rgb video and write to file
+    takes an rgb video, or any iterable of rgb frames, and write to file
     """
-    _, height, width, _ = video.shape
-    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
-    video_writer = cv2.VideoWriter(output_name, fourcc, fps, (width, height))
-    for frame in video:
-        frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        video_writer.write(frame_bgr)
-    video_writer.release()
+    with BackgroundVideoWriter(output_name, fps) as video_writer:
+        for frame in video:
+            video_writer.write(frame)
     print(f"Heatmap video saved as {output_name}")
 
 
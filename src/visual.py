@@ -1,7 +1,10 @@
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.signal import find_peaks, welch
+from scipy.signal import welch
+
+from signals import PeakRateTracker
+from utils import BackgroundVideoWriter
 
 
 def draw_signals(signals, output_file):
@@ -53,70 +56,91 @@ def draw_psd(signal, fs=30.0):
     plt.savefig("./out/psd.png")
 
 
-def draw_box(
-    video, fps, center_point, window_size, s, boxed_video_path="./out/face.mp4"
-):
+def get_colormap_lut(colormap=cv2.COLORMAP_JET):
+    """
+    (256, 3) rgb lookup table, lut[v] == cvtColor(applyColorMap(v), BGR2RGB)
+    """
+    gray = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    return cv2.applyColorMap(gray, colormap)[:, 0, ::-1].copy()
 
-    window_radius = window_size // 2
-    n_frames, height, width, _ = video.shape
 
-    boxed_video = cv2.VideoWriter(
-        boxed_video_path,
-        cv2.VideoWriter_fourcc(*"mp4v"),
-        fps,
-        (width, height),
+def get_patch_index_map(n_patches_h, n_patches_w, window_size, height, width):
+    """
+    (height, width) map from every pixel to the flat index i * n_patches_w + j of
+    the patch covering it. pixels outside the patch grid map to the extra index
+    n_patches_h * n_patches_w
+    """
+    index_map = np.full((height, width), n_patches_h * n_patches_w, dtype=np.intp)
+    patch_indices = np.arange(n_patches_h * n_patches_w).reshape(
+        n_patches_h, n_patches_w
+    )
+    index_map[: n_patches_h * window_size, : n_patches_w * window_size] = np.repeat(
+        np.repeat(patch_indices, window_size, axis=0), window_size, axis=1
     )
+    return index_map
+
+
+def iter_heatmap_frames(patch_values, index_map, lut, background=0):
+    """
+    yields one rgb heatmap frame of index_map's shape per item of patch_values,
+    each a flat uint8 array with one value per patch. the colormap is applied to
+    the patch values before they are expanded to pixels, so per frame the work
+    is one gather through index_map.
+    """
+    for values in patch_values:
+        colors = lut[np.append(values, np.uint8(background))]
+        yield colors[index_map]
+
+
+def iter_boxed_frames(frames, fps, center_point, window_size, s):
+    """
+    yields each rgb frame with the box around center_point, the trace of s up to
+    that frame and the BPM drawn on it. the trace canvas is extended by one segment
+    per frame and the BPM is tracked from streamed peaks, so the work per frame
+    does not grow with the frame index. the BPM is that of find_peaks on the last
+    3 s on a clean signal but not on a noisy one, see PeakRateTracker.
+    """
+    window_radius = window_size // 2
+    top_left = (center_point[1] - window_radius, center_point[0] - window_radius)
+    bottom_right = (center_point[1] + window_radius, center_point[0] + window_radius)
 
-    boxed_frames = []
+    signal_height = 50  # height of the signal overlay area
+    normalized_signal = (s - np.min(s)) / (np.max(s) - np.min(s)) * (signal_height - 1)
+    trace_y = signal_height - normalized_signal.astype(int)
 
-    for i in range(n_frames):
-        frame = video[i].astype(np.uint8)
-        top_left = (center_point[1] - window_radius, center_point[0] - window_radius)
-        bottom_right = (
-            center_point[1] + window_radius,
-            center_point[0] + window_radius,
-        )
-        boxed_frame = cv2.rectangle(
-            frame.copy(), top_left, bottom_right, (0, 255, 0), 1
-        )
+    bpm_tracker = PeakRateTracker(fps, window_seconds=3.0)
+    bpm = 0
+    signal_overlay = None
 
-        signal_height = 50  # height of the signal overlay area
-        signal_width = frame.shape[1]
-        signal_overlay = np.zeros((signal_height, signal_width, 3), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        height, width, _ = frame.shape
+        unit = max(width // 520, 1)
+        if signal_overlay is None:
+            signal_overlay = np.zeros((signal_height, width, 3), dtype=np.uint8)
 
-        normalized_signal = (
-            (s - np.min(s)) / (np.max(s) - np.min(s)) * (signal_height - 1)
+        boxed_frame = cv2.rectangle(
+            np.array(frame, dtype=np.uint8), top_left, bottom_right, (0, 255, 0), 1
         )
 
-        unit = max(width // 520, 1)
-        # draw the signal line
-        for j in range(1, len(normalized_signal)):
-            if j < i:
-                cv2.line(
-                    signal_overlay,
-                    (j - 1, signal_height - int(normalized_signal[j - 1])),
-                    (j, signal_height - int(normalized_signal[j])),
-                    (0, 255, 0),
-                    unit,
-                )
+        # segment j is drawn from frame j + 1 on
+        j = i - 1
+        if 1 <= j < len(trace_y):
+            cv2.line(
+                signal_overlay,
+                (j - 1, int(trace_y[j - 1])),
+                (j, int(trace_y[j])),
+                (0, 255, 0),
+                unit,
+            )
 
         # TODO:  box not visilbe
         boxed_frame[-signal_height:, :] = cv2.addWeighted(
             boxed_frame[-signal_height:, :], 0.5, signal_overlay, 0.5, 0
         )
 
-        window_size = int(3 * fps)
-        start_idx = max(0, i - window_size)
-        window_signal = s[start_idx:i]
-
-        peaks, _ = find_peaks(window_signal, distance=fps / 2)
-        if len(peaks) > 1:
-            peak_times = peaks / fps
-            rr_intervals = np.diff(peak_times)
-            avg_rr_interval = np.mean(rr_intervals)
-            bpm = 60 / avg_rr_interval
-        else:
-            bpm = 0
+        # the BPM at frame i is over the samples before it
+        if 1 <= i <= len(s):
+            bpm = bpm_tracker.update(s[i - 1])
 
         cv2.putText(
             boxed_frame,
@@ -129,6 +153,23 @@ def draw_box(
             cv2.LINE_AA,
         )
 
-        boxed_video.write(cv2.cvtColor(boxed_frame, cv2.COLOR_RGB2BGR))
-        boxed_frames.append(boxed_frame)
-    return np.array(boxed_frames)  # in RGB
+        yield boxed_frame  # in RGB
+
+
+def draw_box(
+    video,
+    fps,
+    center_point,
+    window_size,
+    s,
+    boxed_video_path="./out/face.mp4",
+    fourcc="mp4v",
+):
+    """
+    annotates the frames of video (an array or any iterable of rgb frames) and
+    encodes them to boxed_video_path as they are produced
+    """
+    with BackgroundVideoWriter(boxed_video_path, fps, fourcc) as boxed_video:
+        for boxed_frame in iter_boxed_frames(video, fps, center_point, window_size, s):
+            boxed_video.write(boxed_frame)
+    print(f"Boxed video saved as {boxed_video_path}")